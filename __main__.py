@@ -12,7 +12,7 @@ import logging
 import optparse
 
 from sync import Sync
-from watch import WatchFolder
+from watch import WatchFolder, WatchScheduler
 
 try:
     import mbotenv
@@ -36,6 +36,16 @@ def getBool(value):
     else:
         return True
 
+def getValue(value, default):
+    """
+    Convert a command line value to the type of the option's default
+    """
+    if isinstance(default, bool):
+        return getBool(value)
+    elif isinstance(default, int):
+        return int(value)
+    return value
+
 if __name__ == "__main__":
 
     usage = 'usage: %prog [options] search location - Watch Folder '
@@ -63,7 +73,25 @@ if __name__ == "__main__":
             'newer':'Only update if the source file is newer than the destination',
             'create':'Create files that don\'t currently exist in destination',
             'purge':'Delete files that don\'t currently exist in destination',
-            'watch':'Keep the sync alive and monitor source folder for changes'}
+            'watch':'Keep the sync alive and monitor source folder for changes',
+            'scanWorkers':'Number of threads used to list directories during the diff',
+            'manifest':'File used to remember directory listings between runs',
+            'hardlinks':'Recreate files that are hardlinked together in the source folder as hardlinks in the destination',
+            'checksum':'Compare file contents instead of modification times',
+            'hashstore':'File used to cache content hashes between runs',
+            'hashWorkers':'Number of threads used to hash files when comparing contents',
+            'copyWorkers':'Number of threads used to copy files',
+            'copyStrategy':'How file data is copied: auto, reflink, copy_file_range, sendfile or copy2',
+            'deltaLimit':'Minimum size in KB of updated files that only have their changed blocks rewritten, needs a filesystem with reflinks (btrfs, XFS), 0 to disable',
+            'sparse':'Only copy the data of sparse files, keeping their holes',
+            'resumeLimit':'Minimum size in KB of files copied so an interrupted copy can resume, 0 to disable',
+            'pruneExcludes':'Skip the contents of excluded directories',
+            'streamBacklog':'Maximum number of diff items waiting to be synced when streaming',
+            'progressInterval':'Minimum milliseconds between progress messages, 0 for every file',
+            'progressQuantum':'Also report progress whenever this many KB are copied, 0 to disable',
+            'journal':'File used to record the progress of a run so it can be resumed without a new diff',
+            'purgeWorkers':'Number of threads used to delete each purged directory',
+            'purgeTrash':'Move purged directories into this folder and delete them in the background. Must be on the same drive as the destination but outside it'}
 
     # Flags
     s = Sync()
@@ -86,6 +114,17 @@ if __name__ == "__main__":
                      dest='watchTitle', action='store', default="", type='string')
     group.add_option('--watchMessage', help='Message to use for the watch folder display',
                      dest='watchMessage', action='store', default="", type='string')
+    group.add_option('--watchBackend', help='How to detect changes: auto, inotify or poll. Default: auto',
+                     dest='watchBackend', action='store', default='auto', type='choice',
+                     choices=['auto', 'inotify', 'poll'])
+    group.add_option('--watchRescan', help='Seconds between full rescans, 0 to rescan on every poll or never with inotify. Default: 60',
+                     dest='watchRescan', action='store', default=60, type='int')
+    group.add_option('--watchWorkers', help='Number of pairs synced at the same time when watching several sources. Default: 4',
+                     dest='watchWorkers', action='store', default=4, type='int')
+    group.add_option('--watchMaxWorkers', help='Most worker threads started in all when replacing stuck ones, 0 for twice watchWorkers. Default: 0',
+                     dest='watchMaxWorkers', action='store', default=0, type='int')
+    group.add_option('--watchReport', help='Seconds between logging the status of each watched pair, 0 to only log it on exit. Default: 300',
+                     dest='watchReport', action='store', default=300, type='int')
     parser.add_option_group(group)
 
     # Parse
@@ -112,7 +151,7 @@ if __name__ == "__main__":
         kwargs = {}
         for item in opts:
             val = getattr(options, item)
-            if val: kwargs[item] = getBool(val)
+            if val: kwargs[item] = getValue(val, opts[item])
         
         title = options.watchTitle
         msg = options.watchMessage.replace("\\n", "\n")
@@ -138,6 +177,13 @@ if __name__ == "__main__":
             print "{0}\n{1}\n{0}\n{2}\n{0}\n{3}\n{0}".format("-"*len(title), title, msg, '\n'.join(paths))
 
             # Start the watch folders
-            for index, source in enumerate(sources):
-                w = WatchFolder(source, dests[index], **kwargs)
+            if len(sources) > 1:
+                w = WatchScheduler(zip(sources, dests), workers=options.watchWorkers,
+                                   maxWorkers=options.watchMaxWorkers,
+                                   watchBackend=options.watchBackend,
+                                   watchRescan=options.watchRescan, **kwargs)
+                w.run(reportInterval=options.watchReport)
+            else:
+                w = WatchFolder(sources[0], dests[0], watchBackend=options.watchBackend,
+                                watchRescan=options.watchRescan, **kwargs)
                 w.run()
\ No newline at end of file
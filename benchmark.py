@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.benchmark
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Benchmarks for Diff, Sync and WatchFolder on generated trees
+
+    python benchmark.py run -o before.json
+    python benchmark.py run -o after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py check
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import optparse
+import resource
+import subprocess
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'SCENARIOS',
+    'OPERATIONS',
+    'generate',
+    'runcase',
+    'compare',
+    'checkscan',
+]
+
+OPERATIONS = ['diff', 'sync', 'watch']
+
+# block that file contents are cut from, random so it doesn't compress
+_BLOCK = random.Random(0).getrandbits(8 * 1024 * 1024)
+_BLOCK = ('%x' % _BLOCK).encode('ascii')[:1024 * 1024]
+
+# mtimes used for files that are unchanged, and for outdated dst files
+_OLD = 1000000000
+_OLDER = _OLD - 3600
+
+
+def _write(path, size, mtime=_OLD):
+    """
+    Write a file of the given size and set its mtime
+    """
+    with open(path, 'wb') as fp:
+        while size > 0:
+            n = min(size, len(_BLOCK))
+            fp.write(_BLOCK[:n])
+            size -= n
+    os.utime(path, (mtime, mtime))
+
+
+class _Tree(object):
+    """
+    Records what was generated for a scenario
+    """
+
+    def __init__(self, root):
+        self.src = os.path.join(root, 'src')
+        self.dst = os.path.join(root, 'dst')
+        self.files = 0
+        self.bytes = 0
+        os.makedirs(self.src)
+        os.makedirs(self.dst)
+
+    def add(self, rel, size, src=True, dst=None):
+        """
+        Add a file to src and/or dst. ``dst`` is None to leave it out
+        of dst, or the mtime to give the dst copy.
+        """
+        for root, mtime in [(self.src if src else None, _OLD), (self.dst, dst)]:
+            if root is None or mtime is None:
+                continue
+            path = os.path.join(root, rel)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            _write(path, size, mtime)
+            self.files += 1
+            self.bytes += size
+
+    def link(self, rel, target):
+        """
+        Add a hardlink to the src file ``target`` in src
+        """
+        path = os.path.join(self.src, rel)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        os.link(os.path.join(self.src, target), path)
+        self.files += 1
+
+
+def _deep(tree, rnd, scale):
+    # a few long chains of nested dirs with a handful of files in each
+    for chain in range(max(1, int(4 * scale))):
+        parts = ['chain{0}'.format(chain)]
+        for depth in range(40):
+            parts.append('level{0}'.format(depth))
+            for i in range(4):
+                tree.add(os.path.join(os.path.join(*parts), 'f{0}'.format(i)), rnd.randint(0, 8192))
+
+def _wide(tree, rnd, scale):
+    # a single dir with a lot of files
+    for i in range(int(20000 * scale)):
+        tree.add('f{0}'.format(i), rnd.randint(0, 4096))
+
+def _tiny(tree, rnd, scale):
+    # lots of tiny files in dirs of 100
+    for i in range(int(50000 * scale)):
+        tree.add(os.path.join('d{0}'.format(i // 100), 'f{0}'.format(i)), rnd.randint(0, 256))
+
+def _huge(tree, rnd, scale):
+    # a few large files
+    for i in range(4):
+        tree.add('big{0}'.format(i), int(64 * 1024 * 1024 * scale))
+
+def _mixed(tree, rnd, scale):
+    # 60% unchanged, 20% created, 20% updated, plus 20% purged from dst
+    count = int(10000 * scale)
+    for i in range(count):
+        rel = os.path.join('d{0}'.format(i // 200), 'f{0}'.format(i))
+        size = rnd.randint(0, 64 * 1024)
+        r = rnd.random()
+        if r < 0.6:
+            tree.add(rel, size, dst=_OLD)
+        elif r < 0.8:
+            tree.add(rel, size)
+        else:
+            tree.add(rel, size, dst=_OLDER)
+    for i in range(count // 5):
+        tree.add(os.path.join('d{0}'.format(i // 50), 'old{0}'.format(i)), 1024, src=False, dst=_OLD)
+
+def _links(tree, rnd, scale):
+    # files with up to 3 more hardlinks spread over other dirs
+    for i in range(int(5000 * scale)):
+        rel = os.path.join('d{0}'.format(i // 100), 'f{0}'.format(i))
+        tree.add(rel, rnd.randint(0, 4096))
+        for j in range(rnd.randint(0, 3)):
+            tree.link(os.path.join('l{0}'.format(rnd.randint(0, 49)), 'f{0}_{1}'.format(i, j)), rel)
+
+SCENARIOS = {
+    'deep':_deep,
+    'wide':_wide,
+    'tiny':_tiny,
+    'huge':_huge,
+    'mixed':_mixed,
+    'links':_links,
+}
+
+
+def generate(workdir, name, scale=1.0, seed=0):
+    """
+    Generate the src and dst trees of the given scenario under workdir,
+    reusing them if they were already generated with the same settings.
+    Return a dict describing the trees.
+    """
+    root = os.path.join(workdir, name)
+    infopath = os.path.join(root, 'info.json')
+    if os.path.exists(infopath):
+        with open(infopath) as fp:
+            info = json.load(fp)
+        if info['scale'] == scale and info['seed'] == seed:
+            return info
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    tree = _Tree(root)
+    SCENARIOS[name](tree, random.Random(seed), scale)
+    info = {'name':name, 'scale':scale, 'seed':seed, 'src':tree.src, 'dst':tree.dst,
+            'files':tree.files, 'bytes':tree.bytes}
+    with open(infopath, 'w') as fp:
+        json.dump(info, fp)
+    return info
+
+
+def _syscalls():
+    """
+    Return the number of read and write syscalls made by this process
+    so far, or None if the platform doesn't report them. Only Linux
+    counts these (in /proc/self/io), and stat calls aren't included.
+    """
+    try:
+        with open('/proc/self/io') as fp:
+            io = dict(line.split(':', 1) for line in fp if ':' in line)
+        return int(io['syscr']) + int(io['syscw'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def _peakrss():
+    """
+    Return the peak resident memory of this process in KB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macs report bytes instead of KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _sizes(paths):
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def runcase(info, op, **kwargs):
+    """
+    Time one operation against generated trees and return the results.
+    Syncs run against a scratch copy of dst so the trees can be reused.
+    ``kwargs`` are passed to Diff, Sync or WatchFolder.
+    """
+    if op == 'diff':
+        return _runcase(info, op, info['dst'], kwargs)
+    scratch = info['dst'] + '.run'
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    shutil.copytree(info['dst'], scratch)
+    try:
+        return _runcase(info, op, scratch, kwargs)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def _runcase(info, op, dst, kwargs):
+    from diff import Diff
+    from sync import Sync
+    from watch import WatchFolder
+
+    src = info['src']
+    files = info['files']
+    bytes_ = 0
+    opts = {'create':True, 'update':True, 'purge':True}
+    opts.update(kwargs)
+
+    if op == 'diff':
+        calls = _syscalls()
+        start = time.time()
+        Diff(src, dst, **dict((k, v) for k, v in kwargs.items() if k in Diff.opts))
+        seconds = time.time() - start
+    elif op == 'sync':
+        s = Sync(src, dst, **opts)
+        calls = _syscalls()
+        start = time.time()
+        s.diff()
+        s.run()
+        seconds = time.time() - start
+        done = s.stats['creates'] + s.stats['updates']
+        files = len(done) + len(s.stats['purges'])
+        bytes_ = _sizes(done)
+    elif op == 'watch':
+        opts.setdefault('watchBackend', 'poll')
+        w = WatchFolder(src, dst, **opts)
+        w.progress = lambda msg, perc: None
+        w.setup()
+        # add a file next to about 1% of the files between cycles
+        existing = []
+        for root, dirs, names in os.walk(src):
+            existing.extend([os.path.join(root, x) for x in names])
+        added = ['{0}.new'.format(x) for x in
+                 random.Random(1).sample(existing, max(1, len(existing) // 100))]
+        try:
+            for path in added:
+                _write(path, 4096, time.time())
+            calls = _syscalls()
+            start = time.time()
+            w.cycle()
+            seconds = time.time() - start
+        finally:
+            w.close()
+            for path in added:
+                os.remove(path)
+        files = len(added)
+        bytes_ = 4096 * files
+    else:
+        raise ValueError('unknown operation: {0}'.format(op))
+
+    if calls is not None:
+        calls = _syscalls() - calls
+    seconds = max(seconds, 1e-9)
+    return {
+        'seconds':seconds,
+        'files':files,
+        'bytes':bytes_,
+        'files_per_s':files / seconds,
+        'mb_per_s':bytes_ / seconds / (1024 * 1024) if bytes_ else None,
+        'syscalls':calls,
+        'peak_rss_kb':_peakrss(),
+    }
+
+
+def _runisolated(info, op, kwargs):
+    """
+    Run a case in a separate process so its peak memory is its own
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), 'case', json.dumps(info), op, json.dumps(kwargs)]
+    out = subprocess.check_output(cmd)
+    return json.loads(out.splitlines()[-1])
+
+
+def run(workdir, output, scenarios=None, ops=None, scale=1.0, repeat=3, kwargs=None):
+    """
+    Run the given scenarios and operations, keeping the fastest of
+    ``repeat`` runs of each, and write the results to ``output`` as JSON
+    """
+    kwargs = kwargs or {}
+    results = {}
+    for name in scenarios or sorted(SCENARIOS):
+        LOG.info('generating {0}'.format(name))
+        info = generate(workdir, name, scale)
+        for op in ops or OPERATIONS:
+            best = None
+            for i in range(repeat):
+                result = _runisolated(info, op, kwargs)
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            key = '{0}/{1}'.format(name, op)
+            LOG.info('{0}: {1:.3f}s, {2:.0f} files/s'.format(key, best['seconds'], best['files_per_s']))
+            results[key] = best
+    data = {
+        'meta':{
+            'time':time.time(),
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'scale':scale,
+            'repeat':repeat,
+            'kwargs':kwargs,
+        },
+        'results':results,
+    }
+    with open(output, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    return data
+
+
+def checkscan(info, workers=4):
+    """
+    Diff the trees of a scenario with one scan worker and with ``workers``
+    and return a list of the ways the results differ, which should be none
+    """
+    from diff import Diff
+
+    results = []
+    for n in (1, workers):
+        d = Diff(scanWorkers=n, hardlinks=True)
+        d.src = info['src']
+        d.dst = info['dst']
+        results.append((list(d.events()), d.links))
+    problems = []
+    if results[0][0] != results[1][0]:
+        problems.append('{0}: events differ with {1} scan workers'.format(info['name'], workers))
+    if results[0][1] != results[1][1]:
+        problems.append('{0}: links differ with {1} scan workers'.format(info['name'], workers))
+    return problems
+
+
+def compare(before, after, threshold=10.0):
+    """
+    Return a report comparing two result files, marking cases that got
+    slower by more than ``threshold`` percent
+    """
+    with open(before) as fp:
+        a = json.load(fp)['results']
+    with open(after) as fp:
+        b = json.load(fp)['results']
+    lines = ['{0:<16} {1:>10} {2:>10} {3:>8} {4:>12} {5:>12}'.format(
+             'case', 'before', 'after', 'change', 'syscalls', 'rss KB')]
+    for key in sorted(set(a) | set(b)):
+        if key not in a or key not in b:
+            lines.append('{0:<16} only in {1}'.format(key, 'before' if key in a else 'after'))
+            continue
+        x, y = a[key], b[key]
+        change = (y['seconds'] - x['seconds']) / x['seconds'] * 100
+        calls = '-'
+        if x['syscalls'] is not None and y['syscalls'] is not None:
+            calls = '{0:+d}'.format(y['syscalls'] - x['syscalls'])
+        mark = '  SLOWER' if change > threshold else ''
+        lines.append('{0:<16} {1:>9.3f}s {2:>9.3f}s {3:>+7.1f}% {4:>12} {5:>+12d}{6}'.format(
+                     key, x['seconds'], y['seconds'], change, calls,
+                     y['peak_rss_kb'] - x['peak_rss_kb'], mark))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    usage = ('usage: %prog run [options]\n'
+             '       %prog compare before.json after.json\n'
+             '       %prog check [options]')
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-o', '--output', help='Result file to write. Default: benchmark.json',
+                      dest='output', action='store', default='benchmark.json')
+    parser.add_option('-w', '--workdir', help='Where the trees are generated. Default: ./benchmark-trees',
+                      dest='workdir', action='store', default='benchmark-trees')
+    parser.add_option('--scenarios', help='Comma separated scenarios to run: {0}. Default: all'.format(
+                      ', '.join(sorted(SCENARIOS))), dest='scenarios', action='store', default='')
+    parser.add_option('--ops', help='Comma separated operations to time: {0}. Default: all'.format(
+                      ', '.join(OPERATIONS)), dest='ops', action='store', default='')
+    parser.add_option('--scale', help='Multiplier for the size of the trees. Default: 1.0',
+                      dest='scale', action='store', default=1.0, type='float')
+    parser.add_option('--repeat', help='Runs of each case, the fastest is kept. Default: 3',
+                      dest='repeat', action='store', default=3, type='int')
+    parser.add_option('--kwargs', help='JSON object of options passed to Diff/Sync/WatchFolder',
+                      dest='kwargs', action='store', default='{}')
+    parser.add_option('--workers', help='Scan workers compared with a serial scan by check. Default: 4',
+                      dest='workers', action='store', default=4, type='int')
+    parser.add_option('--threshold', help='Percent slowdown reported by compare. Default: 10',
+                      dest='threshold', action='store', default=10.0, type='float')
+    (options, args) = parser.parse_args()
+
+    if args and args[0] == 'case':
+        # internal, runs a single case for run()
+        info, op, kwargs = json.loads(args[1]), args[2], json.loads(args[3])
+        # json gives back unicode, keep paths and keywords as str
+        info = dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in info.items())
+        kwargs = dict((str(k), v) for k, v in kwargs.items())
+        logging.disable(logging.CRITICAL)
+        print json.dumps(runcase(info, op, **kwargs))
+    elif args and args[0] == 'run':
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        run(options.workdir, options.output,
+            scenarios=[x for x in options.scenarios.split(',') if x],
+            ops=[x for x in options.ops.split(',') if x],
+            scale=options.scale, repeat=options.repeat,
+            kwargs=json.loads(options.kwargs))
+    elif len(args) == 3 and args[0] == 'compare':
+        print compare(args[1], args[2], options.threshold)
+    elif args and args[0] == 'check':
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        problems = []
+        for name in [x for x in options.scenarios.split(',') if x] or sorted(SCENARIOS):
+            info = generate(options.workdir, name, options.scale)
+            problems.extend(checkscan(info, options.workers))
+        for problem in problems:
+            LOG.error(problem)
+        sys.exit(1 if problems else 0)
+    else:
+        parser.print_help()
@@ -13,10 +13,21 @@ import stat
 import time
 import sys
 import shutil
-import filecmp
+import Queue
 import logging
+import itertools
+import threading
+import collections
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 import utils
+import transfer
+import report as _report
+from manifest import Manifest
+from hashstore import HashStore
+from difftable import DiffTable
+from filters import Filter
 
 try:
     import mbotenv
@@ -25,6 +36,42 @@ except:
     import logging
     LOG = logging.getLogger(__name__)
 
+# names skipped by filecmp.dircmp, which previously drove the diff walk
+IGNORES = ['RCS', 'CVS', 'tags']
+
+# number of ``filelist`` paths grouped by dir before they are compared
+FILELISTBATCH = 10000
+
+# dirs with fewer ``filelist`` paths than this stat each path instead
+# of listing the whole dir
+FILELISTSTAT = 4
+
+# number of levels each scan worker may compare ahead of the level
+# being yielded
+SCANAHEAD = 4
+
+# number of content comparisons each hash worker may have pending
+# before the walk waits for the oldest
+HASHAHEAD = 64
+
+def _prefixes(*roots):
+    """
+    Return the normcase'd roots with a trailing separator
+    for ``_striproot``
+    """
+    return [os.path.join(os.path.normcase(os.path.normpath(x)), '') for x in roots]
+
+def _striproot(path, prefixes):
+    """
+    Return the given path relative to the first of the ``prefixes``
+    it starts with, or unchanged if it's in none of them
+    """
+    key = os.path.normcase(path)
+    for prefix in prefixes:
+        if key.startswith(prefix):
+            return path[len(prefix):]
+    return path
+
 class Diff(object):
     """
     Diff compares two directories (src and dst) and compiles a list of
@@ -34,16 +81,61 @@ class Diff(object):
 
     Optionally, a file path list can be supplied to limit the sync between
     the src and dst.  This file list can either be relative paths or include
-    the src or dst prefixes in their file paths.
+    the src or dst prefixes in their file paths. ``filelist`` can be any
+    iterable of paths, such as a generator or an open file with one path
+    per line, or the path of such a file. The paths are read in batches
+    of ``FILELISTBATCH`` and grouped by dir, and each dir is listed once
+    on each side to find the entries for all of its paths.
     
     If both a src and dst path are passed on creation, the comparison is run
     automatically, otherwise the run() method must be called manually once
     both paths are set.
     
+    Alternatively, a list of relative directory paths can be supplied as
+    ``dirlist`` to only compare the contents of those directories. Their
+    subdirectories are only descended into if they exist on one side.
+
+    Setting ``scanWorkers`` above 1 lists directories on a pool of threads,
+    which helps on network filesystems where each listing waits on latency.
+    The results, and the order ``events`` yields them in, are identical
+    to the serial walk.
+
+    Setting ``manifest`` to a file path keeps a record of every directory
+    listing between runs (see manifest.Manifest), so directories that
+    haven't been modified since the last run are not listed again.
+
+    Setting ``checksum`` compares the contents of common files instead of
+    their modification times. Files of equal size are hashed on a pool of
+    ``hashWorkers`` threads while the walk continues, and the hashes are
+    cached (see hashstore.HashStore) in the ``hashstore`` file if one is given.
+
+    ``filters`` and ``excludes`` take regexes (or plain text if
+    ``regexfilters`` is False), or rules prefixed with 're:', 'glob:' or
+    'path:' (see filters.Matcher). Directories that match an exclude are
+    not descended into unless ``pruneExcludes`` is False, in which case
+    only the dir itself is left out and its contents are still compared.
+
+    If a statcache.StatCache is given as ``statcache``, the entries of
+    everything that ends up in the diff are added to it.
+
+    If a metrics.Metrics is given as ``metrics``, the time taken to list
+    and compare each directory is recorded in it.
+
+    Setting ``hardlinks`` groups the files being created or updated by
+    their device and inode, so files that are hardlinked together in src
+    can be linked together in dst. Once the walk has finished, ``links``
+    maps the src path of each file to the first path of its group in
+    sorted order, which isn't in ``links`` itself. Links to files that
+    aren't in the diff are not detected.
+
     Main attributes are:
         ``create`` -- a dictionary of files/dirs that only exist in src
         ``update`` -- a dictionary of files/dirs that are newer in src
         ``purge`` -- a dictionary of files/dirs that only exist in dst
+        ``links`` -- a dictionary of hardlinked files, see ``hardlinks``
+
+    Each is a difftable.DiffTable mapping directories to the names
+    found in them.
     
     >>> d = Diff(srcDir, dstDir)
     >>> d.report()
@@ -56,22 +148,43 @@ class Diff(object):
     timeprecision = 3
     recursive = True
     newer = True
+    forceUpdate = False
+    sizeLimit = 0
+    scanWorkers = 1
+    manifest = None
+    checksum = False
+    hashstore = None
+    hashWorkers = 4
+    dirlist = None
+    pruneExcludes = True
+    statcache = None
+    metrics = None
+    hardlinks = False
     opts = ['filters', 'excludes', 'regexfilters', 'includedirs', 'timeprecision', 'recursive',\
-            'newer', 'forceUpdate', 'filelist', 'sizeLimit']
+            'newer', 'forceUpdate', 'filelist', 'sizeLimit', 'scanWorkers', 'manifest',\
+            'checksum', 'hashstore', 'hashWorkers', 'dirlist', 'pruneExcludes', 'statcache',\
+            'metrics', 'hardlinks']
     
 
     def __init__(self, src=None, dst=None, **kwargs):
         self.src = os.path.normpath(src) if src is not None else None
         self.dst = os.path.normpath(dst) if src is not None else None
-        self.create = {}
+        self.create = DiffTable()
         self.createcount = 0
-        self.update = {}
+        self.update = DiffTable()
         self.updatecount = 0
-        self.purge = {}
+        self.purge = DiffTable()
         self.purgecount = 0
         self.totalcount = 0
+        self.links = {}
         # update options
         self.filelist = None
+        self.__index = None
+        self.__hashes = None
+        self.__hashpool = None
+        self.__checksums = collections.deque()
+        self.__inodes = {}
+        self.__inodelock = threading.Lock()
         for k, v in kwargs.items():
             if k in self.opts:
                 setattr(self, k, v)
@@ -84,65 +197,33 @@ class Diff(object):
         """
         Return a list of files with the srcFolder and dstFolder
         removed from the beginning of the file name.
-        """
-
-        srcFolder = os.path.normpath(srcFolder)
-        dstFolder = os.path.normpath(dstFolder)
-
-        # Make sure there is a trailing slash to make sure the
-        # entire folder name matches
-        platform = utils.get_os()
-        if srcFolder[-1] != '\\':
-            if platform in ('mac','linux'):
-                srcFolder += '/'
-            else:
-                srcFolder += '\\'
-        if dstFolder[-1] != '\\':
-            if platform in ('mac','linux'):
-                dstFolder += '/'
-            else:
-                dstFolder += '\\'
-
-        result = []
-        for path in relativeFileList:
-            # Compare paths using the file systems case sensitivity
-            rel = os.path.normcase(os.path.normpath(path))
-            rel = rel.replace(os.path.normcase(srcFolder), '')
-            rel = rel.replace(os.path.normcase(dstFolder), '')
-
-            # Substitute the original path case into the result
-            rel = path[-len(rel):]
-
-            result.append(rel)
-        return result
 
+        Deprecated, ``filelist`` takes paths in src or dst as they are.
+        """
+        LOG.warning('Filesync Deprecation Warning: \'makeFileListRelative\' is no longer needed, '
+                    'pass the paths to \'filelist\' as they are')
+        prefixes = _prefixes(srcFolder, dstFolder)
+        return [_striproot(os.path.normpath(path), prefixes) for path in relativeFileList]
 
     def copy(self):
         """
-        Return a deep copy of self
+        Return a copy of self. The results are copied on write
+        (see difftable.DiffTable), so this is cheap even for large diffs.
+        ``links`` and a ``filelist`` list or set are copied as well, so
+        running either diff again doesn't change the other.
         """
-        from copy import deepcopy
         d = Diff()
-        d.__dict__ = deepcopy(self.__dict__)
+        d.__dict__ = dict(self.__dict__)
+        d.create = self.create.copy()
+        d.update = self.update.copy()
+        d.purge = self.purge.copy()
+        d.links = dict(self.links)
+        if isinstance(self.filelist, (list, set)):
+            d.filelist = type(self.filelist)(self.filelist)
+        d.__inodes = dict((k, list(v)) for k, v in self.__inodes.items())
+        d.__inodelock = threading.Lock()
         return d
     
-    def __tmpdir(self):
-        """
-        Return an empty directory created in the users tmp dir
-        """
-        tmp = None
-        if os.environ.has_key('TMP'):
-            tmp = os.environ['TMP']
-        elif os.environ.has_key('TMPDIR'):
-            tmp = os.environ['TMPDIR']
-        else:
-            tmp = os.path.expanduser('~')
-        tmpdir = os.path.join(tmp, '__dirdiff_tmp')
-        if not os.path.exists(tmpdir):
-            os.mkdir(tmpdir)
-        return tmpdir
-    
-
     def __norm(self, x):
         return os.path.normpath(x)
     
@@ -151,9 +232,10 @@ class Diff(object):
         return '{0}{1}'.format(x.rstrip('/\\'), os.sep)
 
     def clearFiles(self):
-        self.create = {}
-        self.update = {}
-        self.purge = {}
+        self.create = DiffTable()
+        self.update = DiffTable()
+        self.purge = DiffTable()
+        self.links = {}
 
     def _add(self, op, path):
         # rstrip the path so we ensure a common starting point
@@ -163,14 +245,10 @@ class Diff(object):
         dir_, base = os.path.split(path)
         # normalize the parent directory
         dir_ = self.__norm(dir_)
-        # get the list corresponding to the given mode
-        attr = getattr(self, op)
-        if not attr.has_key(dir_):
-            attr[dir_] = []
         # make the base look like a dir if it is
         if utils._isdir(path):
             base = self.__asdir(base)
-        attr[dir_].append(base)
+        getattr(self, op).add(dir_, base)
     
     def add_create(self, path):
         self._add('create', path)
@@ -185,25 +263,60 @@ class Diff(object):
         """
         Remove the given path from the given attribute
         """
-        # rstrip the path so we ensure a common starting point
-        path = path.rstrip('/\\')
         if not op in ['create', 'update', 'purge']:
             return
+        if self.__discard(getattr(self, op), path):
+            self.update_counts(ops=[op])
+
+    def __discard(self, attr, path):
+        # rstrip the path so we ensure a common starting point
+        path = path.rstrip('/\\')
         dir_, base = os.path.split(path)
         dir_ = self.__norm(dir_)
-        # get the list corresponding to the given mode
+        # dirs are stored with a trailing sep, files without
+        return attr.discard(dir_, base) or attr.discard(dir_, self.__asdir(base))
+
+    def trim(self, op, paths=None, prefixes=None, predicate=None):
+        """
+        Remove many entries from the given attribute at once. Paths are
+        only matched against the diff, nothing is looked up on disk, and
+        the counts are updated once at the end.
+        Return the number of entries removed.
+
+        ``paths`` -- any iterable of full paths to remove
+        ``prefixes`` -- full dir paths to remove along with everything in them
+        ``predicate`` -- a function called with the full path of each entry,
+            returning True if the entry should be removed. Dirs are passed
+            with a trailing separator.
+        """
+        if not op in ['create', 'update', 'purge']:
+            return 0
         attr = getattr(self, op)
-        # Make sure the path exists
-        if os.path.exists(path):
-            # make the base look like a dir if it is
-            if utils._isdir(path):
-                base = self.__asdir(base)
-            if attr.has_key(dir_):
-                if base in attr[dir_]:
-                    attr[dir_].remove(base)
-                    if len(attr[dir_]) == 0:
+        before = attr.count()
+        if paths:
+            for path in paths:
+                self.__discard(attr, path)
+        if prefixes:
+            prefixes = set([self.__norm(x) for x in prefixes])
+            for dir_ in attr.keys():
+                # check the dir and each of its parents
+                p = dir_
+                while True:
+                    if p in prefixes:
                         del attr[dir_]
-            self.update_counts(ops=[op])
+                        break
+                    parent = os.path.dirname(p)
+                    if parent == p:
+                        break
+                    p = parent
+            for prefix in prefixes:
+                self.__discard(attr, prefix)
+        if predicate is not None:
+            for dir_, names in attr.items():
+                for name in [x for x in names if predicate(os.path.join(dir_, x))]:
+                    attr.discard(dir_, name)
+        self.update_counts(ops=[op])
+        return before - getattr(self, '{0}count'.format(op))
 
     def remove_create(self, path):
         self._remove('create', path)
@@ -235,202 +348,607 @@ class Diff(object):
         """
         Compare a list of relative file paths to a
         source and destination folder.
-        """
-        result = {}
-        result['left_only'] = []
-        result['common'] = []
-        result['right_only'] = []
-        result['missing'] = []
 
+        Deprecated, pass the paths as ``filelist`` instead.
+        """
+        LOG.warning('Filesync Deprecation Warning: \'compareFileList\' is no longer supported, '
+                    'use \'filelist\' instead')
+        result = {'left_only':[], 'common':[], 'right_only':[], 'missing':[]}
         for relPath in relativeFileList:
-            srcPath = self.getSrcPath(relPath)
-            dstPath = self.getDstPath(relPath)
-            srcExists = os.path.exists(srcPath)
-            dstExists = os.path.exists(dstPath)
+            srcExists = os.path.exists(self.getSrcPath(relPath))
+            dstExists = os.path.exists(self.getDstPath(relPath))
             if srcExists and dstExists:
                 result['common'].append(relPath)
-            elif srcExists and not dstExists:
+            elif srcExists:
                 result['left_only'].append(relPath)
-            elif not srcExists and dstExists:
+            elif dstExists:
                 result['right_only'].append(relPath)
             else:
                 result['missing'].append(relPath)
-
         # Wrap the results in a simple class
         return type("FileCmp", (), result)
 
     def run(self):
-        # compile filters and excludes
-        tmpFilters = self.filters[:]
-        if tmpFilters:
-            if not self.regexfilters:
-                tmpFilters = [re.escape(x) for x in tmpFilters]
-            tmpFilters = [re.compile(x) for x in tmpFilters]
-        tmpExcludes = self.excludes[:]
-        if tmpExcludes:
-            if not self.regexfilters:
-                tmpExcludes = [re.escape(x) for x in tmpExcludes]
-            tmpExcludes = [re.compile(x) for x in tmpExcludes]
-
-        def __filter(name, path=None):
-            result = False
-            # filter with filters
-            if not tmpFilters:
-                result = True
+        self.clearFiles()
+        for src, dst, create, update, purge in self.__levels():
+            self.__merge(src, dst, create, update, purge)
+        if self.checksum:
+            # checksum results come later, keep the same order as the walk
+            for dir_ in self.update.keys():
+                self.update.setdefault(dir_).sort(key=os.path.normcase)
+        self.update_counts()
+
+    def events(self):
+        """
+        Compare src and dst like ``run``, but yield (op, dir, name) tuples
+        as soon as they are found instead of collecting them in ``create``,
+        ``update`` and ``purge``, which are left untouched. ``dir`` is
+        in src for creates and updates and in dst for purges. Names of
+        dirs end with a separator like in the diff lists.
+
+        Dirs are yielded before anything inside them. With ``checksum``
+        enabled, the updates of files that had to be hashed come later,
+        once more than ``HASHAHEAD`` comparisons per hash worker are
+        pending or the walk has finished.
+
+        Memory use doesn't depend on the size of the trees, except that
+        ``hardlinks`` keeps every file with more than one link until the
+        walk has finished to group them, and the hashes of ``checksum``
+        are held until the hash store is saved at the end.
+        """
+        for src, dst, create, update, purge in self.__levels():
+            for name in create:
+                yield 'create', src, name
+            for name in update:
+                yield 'update', src, name
+            for name in purge:
+                yield 'purge', dst, name
+
+    def __levels(self):
+        """
+        Generator that runs the comparison for ``run`` and ``events``,
+        yielding a (src, dst, create, update, purge) tuple for every
+        directory level that was compared
+        """
+        filt = self._compilefilter()
+        if self.manifest:
+            self.__index = Manifest(self.manifest)
+        if self.checksum:
+            self.__hashes = HashStore(self.hashstore)
+            self.__hashpool = ThreadPool(max(self.hashWorkers, 1))
+        try:
+            if self.__hasfilelist():
+                levels = self.__filelistdiff(filt)
+            elif self.dirlist:
+                levels = self.__dirlistdiff(self.dirlist, filt)
             else:
-                for f in tmpFilters:
-                    if f.search(name):
-                        result = True
-            # filter with excludes
-            if tmpExcludes:
-                for e in tmpExcludes:
-                    if e.search(name):
-                        result = False
-            # filter with size
-            if path:
-                if self.sizeLimit and self.sizeLimit > 0:
-                    size = os.path.getsize(path) / 1024
-                    if size < self.sizeLimit:
-                        result = False
-            return result
-
-        def processCmp(cmp, src, dst, tmpdir, **kwargs):
-            """
-            Process the results from a comparison.
-            Compare should include:
-                left_only
-                common
-                right_only
-            """
-            diff = Diff(**kwargs)
+                levels = self._walk(self.src, self.dst, filt)
+            for level in levels:
+                yield level
+                if self.__hashes is not None:
+                    for dir_, base in self.__resolvechecksums(max(self.hashWorkers, 1) * HASHAHEAD):
+                        yield dir_, None, [], [base], []
+            if self.__index is not None:
+                LOG.debug('manifest listings reused: {0}, relisted: {1}'.format(
+                          self.__index.hits, self.__index.misses))
+                self.__index.save()
+            if self.__hashes is not None:
+                for dir_, base in self.__resolvechecksums():
+                    yield dir_, None, [], [base], []
+                LOG.debug('cached hashes reused: {0}, files hashed: {1}'.format(
+                          self.__hashes.hits, self.__hashes.misses))
+                self.__hashes.save()
+            self.__resolvelinks()
+        finally:
+            if self.__index is not None:
+                self.__index.close()
+                self.__index = None
+            if self.__hashpool is not None:
+                self.__hashpool.terminate()
+                self.__hashpool.join()
+                self.__hashpool = None
+            if self.__hashes is not None:
+                self.__hashes.close()
+                self.__hashes = None
+            self.__checksums = collections.deque()
+            self.__inodes = {}
+
+    def _compilefilter(self):
+        """
+        Compile the filters and excludes into a filters.Filter, which
+        takes a name and an optional directory entry and returns
+        True if the item should be included in the diff.
+        """
+        return Filter(self.filters, self.excludes, self.regexfilters, self.sizeLimit,
+                      (self.src, self.dst))
+
+    def __prune(self, filt, name, entry):
+        """
+        Return True if the given dir shouldn't be descended into
+        """
+        return self.pruneExcludes and filt.prune(name, entry)
 
+    def _listdir(self, path, ignore=True):
+        """
+        Return a list of (key, entry) tuples for the given directory
+        sorted by key, where key is the case normalized name.
+        A path of None is treated as an empty directory.
+        ``ignore`` -- leave out the names in ``IGNORES``
+        """
+        if path is None:
+            return []
+        if self.__index is not None:
+            entries = self.__index.listdir(path)
+        else:
+            entries = utils._scandir(path)
+        # unfinished resumable copies are neither synced nor purged
+        result = [(os.path.normcase(e.name), e) for e in entries
+                  if not (ignore and e.name in IGNORES) and not transfer.ispartial(e.name)]
+        result.sort(key=lambda x: x[0])
+        return result
+
+    def _compare(self, name, left, right, filt):
+        """
+        Compare a single item that exists in src (``left``), dst (``right``)
+        or both, where ``left`` and ``right`` are directory entries or None.
+
+        Returns a tuple of (op, entry, subdirs) where ``op`` is the diff
+        attribute the ``entry`` belongs to (or None), and ``subdirs`` is a
+        (src, dst) pair of directories that still need to be compared (or None).
+        An ``op`` of 'checksum' means the contents need to be compared
+        before the entry can be added to ``update``.
+        """
+        if right is None:
             # create files
-            if cmp.left_only:
-                for x in sorted(cmp.left_only):
-                    x = os.path.normpath(re.sub(r"^[\\/]+", "", x))
-                    srcp = os.path.join(src, x)
-                    if utils._isfile(srcp):
-                        if __filter(x, srcp):
-                            diff.add_create(srcp)
-                    elif utils._isdir(srcp):
-                        if self.includedirs:
-                            if __filter(x, srcp):
-                                diff.add_create(srcp)
-                        if self.recursive:
-                            # recurse into the dir
-                            d = __dirdiff(srcp, None, tmpdir, **kwargs)
-                            diff.create.update(d.create)
-            
-            # update files
-            if cmp.common:
-                for x in sorted(cmp.common):
-                    x = os.path.normpath(re.sub(r"^[\\/]+", "", x))
-                    srcp = os.path.join(src, x)
-                    dstp = os.path.join(dst, x)
-                    if utils._isfile(srcp):
-                        if utils._cmp_mtime(srcp, dstp, self.timeprecision, self.newer):
-                            if __filter(x, srcp):
-                                diff.add_update(srcp)
-                        if self.forceUpdate:
-                            diff.add_update(srcp)
-                    elif utils._isdir(srcp) and self.recursive:
-                        # recurse into the dir; the dir itself never gets added
-                        d = __dirdiff(srcp, dstp, tmpdir, **kwargs)
-                        # during an existing dir scan we may come across more info
-                        diff.create.update(d.create)
-                        diff.update.update(d.update)
-                        diff.purge.update(d.purge)
-            
+            if utils._entry_isfile(left):
+                if filt(name, left):
+                    return 'create', left, None
+            elif utils._entry_isdir(left):
+                op = None
+                if self.includedirs and filt(name, left):
+                    op = 'create'
+                sub = None
+                if self.recursive and not self.__prune(filt, name, left):
+                    sub = (left.path, None)
+                return op, left, sub
+        elif left is None:
             # purge files
-            if cmp.right_only:
-                for x in sorted(cmp.right_only):
-                    x = os.path.normpath(re.sub(r"^[\\/]+", "", x))
-                    dstp = os.path.join(dst, x)
-                    if utils._isfile(dstp):
-                        if __filter(x):
-                            diff.add_purge(dstp)
-                    elif utils._isdir(dstp):
-                        # always include purge directories
-                        if __filter(x):
-                            diff.add_purge(dstp)
-                        if self.recursive:
-                            d = __dirdiff(None, dstp, tmpdir, **kwargs)
-                            diff.purge.update(d.purge)
-
-            return diff
-
-
-        def __dirdiff(src, dst, tmpdir, **kwargs):
-            """
-            Recursively compare src and dst directories and compile the
-            results using dummy Diff instances.
-            
-            Returns a Diff instance with accurate create/update attributes
-            ``tmpdir`` -- an empty directory used for performing null comparisons
-            """
-            if src is None:
-                src = tmpdir
-            if dst is None:
-                dst = tmpdir
-            # compare directories
-            LOG.debug('{0}, {1}'.format(src, dst))
-            c = filecmp.dircmp(src, dst)
-            return processCmp(c, src, dst, tmpdir)
-
-
-        def __filediff(relFileList, src, dst, tmpdir, **kwargs):
-            """
-            Compare a relative file path list between
-            source and destination directories
-            """
-            if src is None:
-                src = tmpdir
-            if dst is None:
-                dst = tmpdir
-            # compare file lists
-            c = self.compareFileList(relFileList, src, dst)
-            return processCmp(c, src, dst, tmpdir)
-        
-        # run the recursive function
-        tmp = self.__tmpdir()
-        kw = {}
-        for opt in self.opts:
-            kw[opt] = getattr(self, opt)
-
-        src = self.src
-        dst = self.dst
-        if src is None:
-            src = tmp
-        if dst is None:
-            dst = tmp
-        if self.filelist is not None and len(self.filelist) > 0:
-            self.filelist = self.makeFileListRelative(self.filelist, src, dst)
-            d = __filediff(self.filelist, self.src, self.dst, tmp, **kw)
+            if utils._entry_isfile(right):
+                if filt(name, right, size=False):
+                    return 'purge', right, None
+            elif utils._entry_isdir(right):
+                # always include purge directories
+                op = 'purge' if filt(name, right, size=False) else None
+                sub = None
+                if self.recursive and not self.__prune(filt, name, right):
+                    sub = (None, right.path)
+                return op, right, sub
         else:
-            d = __dirdiff(self.src, self.dst, tmp, **kw)
-        if os.path.isdir(tmp):
-            if os.path.exists(tmp):
-                os.rmdir(os.path.normpath(tmp))
-        # update this instance's attributes
-        self.create = d.create
-        self.update = d.update
-        self.purge = d.purge
-        self.update_counts()
-    
+            # update files
+            if utils._entry_isfile(left):
+                if self.forceUpdate:
+                    return 'update', left, None
+                if self.checksum:
+                    if filt(name, left):
+                        if not utils._entry_isfile(right):
+                            return 'update', left, None
+                        if left.stat().st_size != right.stat().st_size:
+                            return 'update', left, None
+                        return 'checksum', left, None
+                elif utils._cmp_stat_mtime(left.stat(), right.stat(), self.timeprecision, self.newer):
+                    if filt(name, left):
+                        return 'update', left, None
+            elif utils._entry_isdir(left) and self.recursive:
+                if self.__prune(filt, name, left):
+                    return None, None, None
+                # the dir itself never gets added
+                dst = right.path if utils._entry_isdir(right) else None
+                return None, None, (left.path, dst)
+        return None, None, None
+
+    def _scanlevel(self, src, dst, filt):
+        """
+        Compare one level of the src and dst directories by merging
+        their sorted listings in a single pass. Either may be None
+        for a one sided comparison.
+
+        Returns a tuple of (create, update, purge, subdirs) where the first
+        three are lists of basenames and ``subdirs`` is a list of (src, dst)
+        directory pairs to compare next.
+        """
+        result = {'create':[], 'update':[], 'purge':[]}
+        subdirs = []
+        start = time.time()
+        left = self._listdir(src)
+        right = self._listdir(dst)
+        if self.metrics is not None:
+            self.metrics.observe('listdir', time.time() - start)
+        i = j = 0
+        while i < len(left) or j < len(right):
+            if j == len(right) or (i < len(left) and left[i][0] < right[j][0]):
+                l, r = left[i][1], None
+                i += 1
+            elif i == len(left) or right[j][0] < left[i][0]:
+                l, r = None, right[j][1]
+                j += 1
+            else:
+                l, r = left[i][1], right[j][1]
+                i += 1
+                j += 1
+            op, entry, sub = self._compare((l or r).name, l, r, filt)
+            if self.statcache is not None and (op is not None or sub is not None):
+                self.__cache(l, r)
+            if op == 'checksum':
+                self.__checksum(src, l, r)
+            elif op is not None:
+                base = entry.name
+                # make the base look like a dir if it is
+                if utils._entry_isdir(entry):
+                    base = self.__asdir(base)
+                elif self.hardlinks and op != 'purge':
+                    self.__linkgroup(entry)
+                result[op].append(base)
+            if sub is not None:
+                subdirs.append(sub)
+        if self.metrics is not None:
+            self.metrics.dir(src or dst, time.time() - start, len(left) + len(right))
+        return result['create'], result['update'], result['purge'], subdirs
+
+    def _walk(self, src, dst, filt):
+        """
+        Recursively compare the src and dst directories, yielding
+        a (src, dst, create, update, purge) tuple for each level.
+        """
+        if self.scanWorkers and self.scanWorkers > 1:
+            for level in self.__walkparallel(src, dst, filt):
+                yield level
+            return
+        stack = [(src, dst)]
+        while stack:
+            s, d = stack.pop()
+            LOG.debug('{0}, {1}'.format(s, d))
+            create, update, purge, subdirs = self._scanlevel(s, d, filt)
+            yield s, d, create, update, purge
+            stack.extend(reversed(subdirs))
+
+    def __walkparallel(self, src, dst, filt):
+        """
+        Same as ``_walk`` but each directory level is compared on a pool
+        of ``scanWorkers`` threads. The levels that will be yielded next
+        are queued as soon as they are known, and the levels are yielded
+        on the calling thread in the same order as ``_walk``, holding on
+        to any that finish early. At most ``SCANAHEAD`` levels per worker
+        are queued or held at a time.
+        """
+        results = Queue.Queue()
+        keys = itertools.count()
+        def scan(key, s, d):
+            try:
+                results.put((key, self._scanlevel(s, d, filt), None))
+            except Exception as e:
+                results.put((key, None, e))
+
+        pool = ThreadPool(self.scanWorkers)
+        ahead = self.scanWorkers * SCANAHEAD
+        # [key, src, dst] of the levels left to yield, the next one
+        # last, with a key of None until it has been queued
+        stack = [[None, src, dst]]
+        def fill():
+            queued = 0
+            for item in reversed(stack):
+                if queued >= ahead:
+                    break
+                if item[0] is None:
+                    item[0] = next(keys)
+                    pool.apply_async(scan, (item[0], item[1], item[2]))
+                queued += 1
+
+        try:
+            # levels that have been compared but not yielded yet
+            done = {}
+            while stack:
+                fill()
+                key, s, d = stack.pop()
+                while key not in done:
+                    k, level, error = results.get()
+                    if error is not None:
+                        raise error
+                    done[k] = level
+                create, update, purge, subdirs = done.pop(key)
+                LOG.debug('{0}, {1}'.format(s, d))
+                yield s, d, create, update, purge
+                stack.extend([[None, sd, dd] for sd, dd in reversed(subdirs)])
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __linkgroup(self, entry):
+        """
+        Add the given file to the group of files that share its
+        inode, which ``__resolvelinks`` turns into ``links``
+        """
+        try:
+            st = entry.stat()
+        except OSError:
+            return
+        # windows doesn't report inodes or link counts from a listing
+        if getattr(st, 'st_nlink', 1) > 1 and st.st_ino:
+            with self.__inodelock:
+                self.__inodes.setdefault((st.st_dev, st.st_ino), []).append(entry.path)
+
+    def __resolvelinks(self):
+        """
+        Link every file in a group to the first path of the group, so
+        the result doesn't depend on the order the walk found them in
+        """
+        for paths in self.__inodes.values():
+            if len(paths) > 1:
+                first = min(paths)
+                for path in paths:
+                    if path != first:
+                        self.links[path] = first
+
+    def __cache(self, left, right):
+        if left is not None:
+            self.statcache.put(left)
+        if right is not None:
+            self.statcache.put(right)
+
+    def __merge(self, src, dst, create, update, purge):
+        self.create.extend(src, create)
+        self.update.extend(src, update)
+        self.purge.extend(dst, purge)
+
+    def __hasfilelist(self):
+        if self.filelist is None:
+            return False
+        if isinstance(self.filelist, (basestring, list, tuple, set)):
+            return len(self.filelist) > 0
+        return True
+
+    def __filelist(self):
+        """
+        Yield each path in ``filelist`` relative to src or dst,
+        keeping a trailing separator to only match a dir
+        """
+        paths = self.filelist
+        f = None
+        if isinstance(paths, basestring):
+            f = paths = open(paths, 'rb')
+        try:
+            prefixes = _prefixes(self.src, self.dst)
+            for path in paths:
+                path = path.rstrip('\r\n')
+                sep = os.sep if path.endswith(('/', '\\')) else ''
+                path = _striproot(os.path.normpath(path), prefixes).lstrip('/\\')
+                if path and path != os.curdir:
+                    yield path + sep
+        finally:
+            if f is not None:
+                f.close()
+
+    def __filelistdiff(self, filt):
+        """
+        Compare the paths in ``filelist`` between source and destination
+        directories in batches grouped by dir, yielding a level for each dir
+        """
+        # normcase'd dirs whose contents have been walked
+        walked = set()
+        batch = []
+        for rel in self.__filelist():
+            batch.append(rel)
+            if len(batch) >= FILELISTBATCH:
+                for level in self.__filebatch(batch, walked, filt):
+                    yield level
+                batch = []
+        for level in self.__filebatch(batch, walked, filt):
+            yield level
+
+    def __filebatch(self, paths, walked, filt):
+        """
+        Group a batch of ``filelist`` paths by dir and compare them.
+        The comparison recurses into dirs, so paths inside another path
+        of the batch, or inside a dir walked by an earlier batch, are
+        dropped so they aren't in the diff twice.
+        """
+        # sorting by parts puts everything inside a path right after it,
+        # and a path before the same path with a trailing separator
+        paths = sorted(paths, key=lambda x: (os.path.normcase(x.rstrip(os.sep)).split(os.sep), x.endswith(os.sep)))
+        groups = {}
+        last = None
+        for rel in paths:
+            # keep the trailing separator of dirs on the name
+            path = rel.rstrip(os.sep)
+            key = os.path.normcase(path)
+            if last is not None and (key == last or key.startswith(last + os.sep)):
+                continue
+            if self.__walked(key, walked):
+                continue
+            last = key
+            dir_, name = os.path.split(path)
+            groups.setdefault(dir_, set()).add(name + rel[len(path):])
+        return self.__filegroups(groups, walked, filt)
+
+    def __walked(self, key, walked):
+        """
+        Return True if the given normcase'd path is in one of
+        the ``walked`` dirs, or is one of them
+        """
+        while key:
+            if key in walked:
+                return True
+            parent = os.path.dirname(key)
+            if parent == key:
+                break
+            key = parent
+        return False
+
+    def __filegroups(self, groups, walked, filt):
+        for rel in sorted(groups):
+            names = sorted(groups[rel], key=os.path.normcase)
+            src = os.path.normpath(os.path.join(self.src, rel))
+            dst = os.path.normpath(os.path.join(self.dst, rel))
+            left = self.__entries(src, names)
+            right = self.__entries(dst, names)
+            level = {'create':[], 'update':[], 'purge':[]}
+            subdirs = []
+            for name in names:
+                l = self.__lookup(left, name)
+                r = self.__lookup(right, name)
+                name = name.rstrip(os.sep)
+                if l is None and r is None:
+                    continue
+                # filters see the path relative to the root
+                op, entry, sub = self._compare(os.path.join(rel, name), l, r, filt)
+                if self.statcache is not None:
+                    self.__cache(l, r)
+                if op == 'checksum':
+                    self.__checksum(src, l, r)
+                elif op is not None:
+                    base = entry.name
+                    # make the base look like a dir if it is
+                    if utils._entry_isdir(entry):
+                        base = self.__asdir(base)
+                    elif self.hardlinks and op != 'purge':
+                        self.__linkgroup(entry)
+                    level[op].append(base)
+                if sub is not None:
+                    subdirs.append(sub)
+                    walked.add(os.path.normcase(os.path.join(rel, name)))
+            yield src, dst, level['create'], level['update'], level['purge']
+            for s, d in subdirs:
+                for level in self._walk(s, d, filt):
+                    yield level
+
+    def __lookup(self, entries, name):
+        """
+        Return the entry for the given name, names with a
+        trailing separator only match dirs
+        """
+        entry = entries.get(os.path.normcase(name.rstrip(os.sep)))
+        if entry is not None and name.endswith(os.sep) and not utils._entry_isdir(entry):
+            return None
+        return entry
+
+    def __entries(self, dir_, names):
+        """
+        Return a dict of the existing entries of the given names in dir_
+        by their normcase'd name. The dir is listed unless there are only
+        a few names, in which case they are stat'ed instead.
+        """
+        listed = None
+        if len(names) >= FILELISTSTAT:
+            try:
+                if self.__index is not None or utils._scandir_impl is not None:
+                    # names in the filelist are compared even if ignored
+                    return dict(self._listdir(dir_, ignore=False))
+                # without scandir the entries know nothing more than their
+                # names, so only make the ones that are needed
+                listed = set([os.path.normcase(x) for x in os.listdir(dir_)])
+            except OSError:
+                return {}
+        result = {}
+        for name in names:
+            name = name.rstrip(os.sep)
+            key = os.path.normcase(name)
+            if transfer.ispartial(name):
+                continue
+            entry = utils._DirEntry(dir_, name)
+            if listed is not None:
+                if key not in listed:
+                    continue
+            else:
+                try:
+                    entry.stat()
+                except OSError:
+                    continue
+            result[key] = entry
+        return result
+
+    def __dirlistdiff(self, relDirList, filt):
+        """
+        Compare the contents of a list of relative directory paths
+        between source and destination directories. Subdirectories that
+        exist on both sides are left to their own entry in the list.
+        Yields a level for each directory compared.
+        """
+        walked = set()
+        def iswalked(rel):
+            while rel:
+                if rel in walked:
+                    return True
+                rel = os.path.dirname(rel)
+            return False
+
+        for rel in sorted(set([os.path.normpath(x) for x in relDirList])):
+            rel = '' if rel == os.curdir else rel
+            if iswalked(rel):
+                continue
+            if self.pruneExcludes and filt.prunepath(rel):
+                continue
+            src = os.path.normpath(os.path.join(self.src, rel))
+            dst = os.path.normpath(os.path.join(self.dst, rel))
+            src = src if os.path.isdir(src) else None
+            dst = dst if os.path.isdir(dst) else None
+            if src is None and dst is None:
+                continue
+            if src is None or dst is None:
+                for level in self._walk(src, dst, filt):
+                    yield level
+                walked.add(rel)
+                continue
+            create, update, purge, subdirs = self._scanlevel(src, dst, filt)
+            yield src, dst, create, update, purge
+            for s, d in subdirs:
+                if s is None or d is None:
+                    for level in self._walk(s, d, filt):
+                        yield level
+                    walked.add(os.path.relpath(s, self.src) if s else os.path.relpath(d, self.dst))
+
+    def __checksum(self, dir_, left, right):
+        """
+        Queue a content comparison of the given src and dst entries
+        """
+        result = self.__hashpool.apply_async(self.__differs, (left.path, right.path))
+        self.__checksums.append((dir_, left.name, result))
+
+    def __differs(self, srcp, dstp):
+        return self.__hashes.hash(srcp) != self.__hashes.hash(dstp)
+
+    def __resolvechecksums(self, pending=0):
+        """
+        Wait for the oldest queued content comparisons until at most
+        ``pending`` are left, and yield a (dir, name) tuple for each
+        file that differs
+        """
+        while len(self.__checksums) > pending:
+            dir_, base, result = self.__checksums.popleft()
+            try:
+                differs = result.get()
+            except (IOError, OSError) as e:
+                LOG.warning('could not compare contents, assuming changed: {0}'.format(e))
+                differs = True
+            if differs:
+                yield dir_, base
 
     def update_counts(self, ops=['create', 'update', 'purge']):
         if 'create' in ops:
-            self.createcount = len([x for y in self.create.values() for x in y])
+            self.createcount = self.create.count()
         if 'update' in ops:
-            self.updatecount = len([x for y in self.update.values() for x in y])
+            self.updatecount = self.update.count()
         if 'purge' in ops:
-            self.purgecount = len([x for y in self.purge.values() for x in y])
+            self.purgecount = self.purge.count()
         self.totalcount = self.createcount + self.updatecount + self.purgecount
     
 
-    def report(self, create=True, update=True, purge=True):
+    def report(self, create=True, update=True, purge=True, out=None, format='text', summary=False):
         """
         Print a report of the difference that has been compiled
+
+        ``out`` -- a file-like object the report is written to as it is
+            generated. If None the report is logged and returned instead.
+        ``format`` -- 'text', 'jsonl' or 'csv' (see report.WRITERS)
+        ``summary`` -- only report the counts, not every item
         """
         if self.filelist is None:
             LOG.info('No relative file list is defined')
@@ -440,10 +958,9 @@ class Diff(object):
         if self.dst is None:
             LOG.info('No destination path is defined')
             return
-        # build title
-        title = 'Diff Report ({0} -> {1}):'.format(self.src, self.dst)
-        dashes = '-'*len(title)
-        result = '\n{0}\n{1}\n'.format(title, dashes)
+        buf = StringIO() if out is None else None
+        w = _report.writer(out if buf is None else buf, format, summary)
+        w.header('Diff Report ({0} -> {1}):'.format(self.src, self.dst), self.src, self.dst)
         # loop through all attributes
         attrs = []
         if create:
@@ -453,12 +970,14 @@ class Diff(object):
         if purge:
             attrs.append('purge')
         for attr in attrs:
-            count = getattr(self, '{0}count'.format(attr))
-            result += ('\n{attr}: ({0})\n'.format(count, attr=attr.title()))
-            items = sorted(getattr(self, attr).items())
-            for path, files in items:
-                result += ('  {0}{1}\n'.format(path, os.sep))
-                for f in files:
-                    result += ('    {0}\n'.format(f))
-        LOG.info(result)
-        return result
\ No newline at end of file
+            w.section(attr, getattr(self, '{0}count'.format(attr)))
+            if summary:
+                continue
+            for path in sorted(getattr(self, attr).keys()):
+                for f in getattr(self, attr)[path]:
+                    w.item(attr, path, f)
+        w.close()
+        if buf is not None:
+            result = buf.getvalue()
+            LOG.info(result)
+            return result
\ No newline at end of file
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.difftable
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Storage for the create/update/purge results of a Diff
+"""
+
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'DiffTable',
+    'NameList',
+]
+
+
+class NameList(object):
+    """
+    NameList holds the basenames of one directory in a Diff. It behaves
+    like the plain list it replaces, but removing a name doesn't shift
+    the rest of the list: the slot is cleared and the list is compacted
+    once enough slots are empty.
+
+    Lookups by name use an index that is only built the first time
+    a name is searched for or removed, so lists that are only ever
+    appended to and iterated cost no more than a list.
+    """
+
+    __slots__ = ('names', 'index', 'dead')
+
+    def __init__(self, names=None):
+        self.names = list(names) if names is not None else []
+        self.index = None
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.names) - self.dead
+
+    def __iter__(self):
+        if self.dead:
+            return (x for x in self.names if x is not None)
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.__getindex()
+
+    def __getitem__(self, i):
+        self.compact()
+        return self.names[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (NameList, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'NameList({0!r})'.format(list(self))
+
+    def __getindex(self):
+        if self.index is None:
+            self.index = dict((x, i) for i, x in enumerate(self.names) if x is not None)
+        return self.index
+
+    def append(self, name):
+        if self.index is not None:
+            self.index[name] = len(self.names)
+        self.names.append(name)
+
+    def extend(self, names):
+        for name in names:
+            self.append(name)
+
+    def remove(self, name):
+        """
+        Remove the given name, raising ValueError if it isn't in the list
+        """
+        if not self.discard(name):
+            raise ValueError('{0!r} is not in the list'.format(name))
+
+    def discard(self, name):
+        """
+        Remove the given name if it's in the list.
+        Return True if it was removed.
+        """
+        i = self.__getindex().pop(name, None)
+        if i is None:
+            return False
+        self.names[i] = None
+        self.dead += 1
+        if self.dead > len(self.names) // 2:
+            self.compact()
+        return True
+
+    def compact(self):
+        """
+        Drop the slots of removed names
+        """
+        if self.dead:
+            self.names = [x for x in self.names if x is not None]
+            self.dead = 0
+            self.index = None
+
+    def sort(self, key=None):
+        self.compact()
+        self.names.sort(key=key)
+        self.index = None
+
+    def copy(self):
+        result = NameList()
+        result.names = [x for x in self.names if x is not None] if self.dead else self.names[:]
+        return result
+
+
+class DiffTable(dict):
+    """
+    DiffTable maps directory paths to the NameList of basenames in that
+    directory, and is used for the ``create``, ``update`` and ``purge``
+    attributes of Diff.
+
+    Copies share their NameLists until one side changes a directory,
+    at which point only that directory is copied. Changes should go
+    through ``add``, ``extend``, ``discard`` and ``setdefault`` so shared
+    lists are never modified in place; the lists returned by indexing
+    and ``items`` are meant for reading.
+
+    >>> t = DiffTable()
+    >>> t.add('/path/to/dir', 'file')
+    >>> 'file' in t['/path/to/dir']
+    True
+    """
+
+    __slots__ = ('__owned',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        # dirs whose NameList isn't shared with another table
+        self.__owned = set()
+        for k, v in dict(*args, **kwargs).items():
+            self.extend(k, v)
+
+    def __writable(self, dir_):
+        names = dict.get(self, dir_)
+        if names is None:
+            names = NameList()
+            dict.__setitem__(self, dir_, names)
+            self.__owned.add(dir_)
+        elif dir_ not in self.__owned:
+            names = names.copy()
+            dict.__setitem__(self, dir_, names)
+            self.__owned.add(dir_)
+        return names
+
+    def __setitem__(self, dir_, names):
+        if not isinstance(names, NameList):
+            names = NameList(names)
+        dict.__setitem__(self, dir_, names)
+        self.__owned.discard(dir_)
+
+    def __delitem__(self, dir_):
+        dict.__delitem__(self, dir_)
+        self.__owned.discard(dir_)
+
+    def __reduce__(self):
+        return (DiffTable, (dict((k, list(v)) for k, v in self.items()),))
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def setdefault(self, dir_, default=None):
+        """
+        Return a NameList for the given dir that can be changed in place,
+        adding it with the names in ``default`` if it doesn't exist
+        """
+        exists = dir_ in self
+        names = self.__writable(dir_)
+        if not exists and default:
+            names.extend(default)
+        return names
+
+    def clear(self):
+        dict.clear(self)
+        self.__owned.clear()
+
+    def add(self, dir_, name):
+        self.__writable(dir_).append(name)
+
+    def extend(self, dir_, names):
+        if names:
+            self.__writable(dir_).extend(names)
+
+    def contains(self, dir_, name):
+        names = dict.get(self, dir_)
+        return names is not None and name in names
+
+    def discard(self, dir_, name):
+        """
+        Remove the given name from the given dir, dropping the dir
+        once it's empty. Return True if the name was removed.
+        """
+        names = dict.get(self, dir_)
+        if names is None or name not in names:
+            return False
+        names = self.__writable(dir_)
+        names.discard(name)
+        if not names:
+            del self[dir_]
+        return True
+
+    def count(self):
+        """
+        Return the total number of names in all dirs
+        """
+        return sum([len(x) for x in self.values()])
+
+    def copy(self):
+        """
+        Return a copy of this table that shares all NameLists
+        until either table changes them
+        """
+        result = DiffTable()
+        dict.update(result, self)
+        self.__owned.clear()
+        return result
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.filters
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Compiled name filters used by Diff
+"""
+
+import os
+import re
+import fnmatch
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Filter',
+    'Matcher',
+]
+
+# patterns that change meaning when joined with other patterns
+_UNSAFE = re.compile(r'\(\?[aiLmsux]|\\[1-9]|\(\?P=')
+
+
+def _combine(patterns, flags=0):
+    """
+    Return a function that searches a name with all the given patterns
+    at once, or None if there are no patterns
+    """
+    if not patterns:
+        return None
+    if len(patterns) > 1 and not [p for p in patterns if _UNSAFE.search(p)]:
+        try:
+            return re.compile('|'.join(['(?:{0})'.format(p) for p in patterns]), flags).search
+        except re.error:
+            pass
+    compiled = [re.compile(p, flags) for p in patterns]
+    if len(compiled) == 1:
+        return compiled[0].search
+    def search(name):
+        for c in compiled:
+            if c.search(name):
+                return True
+        return False
+    return search
+
+
+def _globpattern(glob):
+    """
+    Return a regex pattern that matches the whole of a name against the glob
+    """
+    pattern = fnmatch.translate(os.path.normcase(glob))
+    # the flags are passed when compiling instead
+    pattern = pattern.replace('(?ms)', '').replace('(?s:', '(?:')
+    return '^{0}'.format(pattern)
+
+
+class Matcher(object):
+    """
+    Matcher compiles a list of rules into a single test. Rules can be:
+        ``re:<pattern>`` -- a regex searched for in the name
+        ``glob:<pattern>`` -- a glob matched against the whole name
+        ``path:<path>`` -- a path relative to the src/dst root, matching
+            that path and everything inside it
+    Rules without a prefix are regexes if ``regex`` is True,
+    otherwise text searched for in the name.
+
+    >>> m = Matcher(['glob:*.tmp', 'path:cache', r're:^\.'])
+    >>> m.match('a.tmp'), m.match('x', 'cache/x'), m.match('.git')
+    (True, True, True)
+    """
+
+    def __init__(self, rules, regex=False):
+        patterns = []
+        globs = []
+        self.prefixes = set()
+        for rule in rules:
+            if rule.startswith('re:'):
+                patterns.append(rule[3:])
+            elif rule.startswith('glob:'):
+                globs.append(_globpattern(rule[5:]))
+            elif rule.startswith('path:'):
+                path = os.path.normpath(rule[5:].strip('/\\'))
+                self.prefixes.add(os.path.normcase(path))
+            else:
+                patterns.append(rule if regex else re.escape(rule))
+        self.__search = _combine(patterns)
+        self.__glob = _combine(globs, re.S)
+
+    def match(self, name, rel=None):
+        """
+        Return True if any rule matches the name, or ``rel``,
+        the path relative to the root
+        """
+        if self.__search is not None and self.__search(name):
+            return True
+        if self.__glob is not None and self.__glob(os.path.normcase(name)):
+            return True
+        if self.prefixes and rel is not None:
+            rel = os.path.normcase(rel)
+            while rel:
+                if rel in self.prefixes:
+                    return True
+                parent = os.path.dirname(rel)
+                if parent == rel:
+                    break
+                rel = parent
+        return False
+
+
+class Filter(object):
+    """
+    Filter decides which items are included in a Diff. An item is
+    included if it matches any of the ``filters`` (or there are none),
+    doesn't match any of the ``excludes`` and, if an entry is given,
+    is at least ``sizeLimit`` KB. Both lists take Matcher rules.
+
+    Name rules are checked before the size, so the entry is only
+    stat'ed for items that would otherwise be included, and the stat is
+    the one the entry already cached during the walk.
+
+    ``roots`` are the src and dst dirs that ``path:`` rules are relative to.
+    """
+
+    def __init__(self, filters=None, excludes=None, regex=False, sizeLimit=0, roots=()):
+        self.includes = Matcher(filters, regex) if filters else None
+        self.excludes = Matcher(excludes, regex) if excludes else None
+        self.sizeLimit = sizeLimit
+        self.__roots = sorted([os.path.join(r, '') for r in roots if r], key=len, reverse=True)
+        self.__paths = bool((self.includes is not None and self.includes.prefixes) or
+                            (self.excludes is not None and self.excludes.prefixes))
+
+    def relpath(self, path):
+        """
+        Return the given path relative to the root it is in
+        """
+        for root in self.__roots:
+            if path.startswith(root):
+                return path[len(root):]
+        return None
+
+    def __rel(self, entry):
+        if self.__paths and entry is not None:
+            return self.relpath(entry.path)
+        return None
+
+    def __call__(self, name, entry=None, size=True):
+        """
+        Return True if the item should be included.
+        ``size`` -- False to skip the size check even if there's an entry
+        """
+        rel = self.__rel(entry)
+        if self.includes is not None and not self.includes.match(name, rel):
+            return False
+        if self.excludes is not None and self.excludes.match(name, rel):
+            return False
+        if size and entry is not None and self.sizeLimit and self.sizeLimit > 0:
+            if entry.stat().st_size // 1024 < self.sizeLimit:
+                return False
+        return True
+
+    def prune(self, name, entry=None):
+        """
+        Return True if the given dir is excluded, so nothing
+        inside it needs to be compared
+        """
+        return self.excludes is not None and self.excludes.match(name, self.__rel(entry))
+
+    def prunepath(self, rel):
+        """
+        Return True if the given path relative to the root
+        is in an excluded dir, or is one
+        """
+        if self.excludes is None:
+            return False
+        parts = [x for x in rel.split(os.sep) if x and x != os.curdir]
+        for i in range(len(parts)):
+            if self.excludes.match(parts[i], os.sep.join(parts[:i + 1])):
+                return True
+        return False
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.hashstore
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Cache of file content hashes used by checksum comparisons
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+import utils
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+try:
+    import xxhash
+    HASHNAME = 'xxh64'
+    _newhash = xxhash.xxh64
+except ImportError:
+    HASHNAME = 'md5'
+    _newhash = hashlib.md5
+
+__all__ = [
+    'HashStore',
+]
+
+# size of the blocks read while hashing
+BLOCKSIZE = 1024 * 1024
+
+# files modified this close to the time they were hashed are not cached,
+# since another write within the same mtime tick would go unnoticed
+RACY = 2.0
+
+
+def hashfile(path):
+    """
+    Return the hex digest of the contents of the given file
+    """
+    h = _newhash()
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(BLOCKSIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class HashStore(object):
+    """
+    HashStore caches content hashes keyed on the device, inode, size,
+    mtime and ctime of the file, so unchanged files are never read twice.
+    The cache is kept in a SQLite file if a path is given, otherwise
+    it only lives as long as the instance.
+
+    Access is thread safe so files can be hashed from a pool of workers.
+
+    >>> h = HashStore('/path/to/job.hashes')
+    >>> h.hash('/path/to/file')
+    >>> h.save()
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.__conn.text_factory = str
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                            'dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, '
+                            'ctime INTEGER, algo TEXT, digest TEXT, '
+                            'PRIMARY KEY (dev, ino, size, mtime, ctime, algo))')
+        self.__conn.commit()
+
+    def close(self):
+        self.__conn.close()
+
+    def __key(self, st):
+        return (st.st_dev, st.st_ino, st.st_size, utils._mtime_ns(st),
+                utils._ctime_ns(st), HASHNAME)
+
+    def get(self, st):
+        """
+        Return the cached digest for the given stat result, or None
+        """
+        key = self.__key(st)
+        with self.__lock:
+            if key in self.__pending:
+                return self.__pending[key]
+            row = self.__conn.execute('SELECT digest FROM hashes WHERE dev=? AND ino=? AND '
+                                      'size=? AND mtime=? AND ctime=? AND algo=?', key).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, st, digest):
+        """
+        Cache the digest for the given stat result.
+        The cache is written to disk on ``save``.
+        """
+        if st.st_mtime >= time.time() - RACY:
+            return
+        with self.__lock:
+            self.__pending[self.__key(st)] = digest
+
+    def hash(self, path):
+        """
+        Return the digest of the given file, reading it only
+        if it isn't already in the cache
+        """
+        st = os.stat(path)
+        digest = self.get(st)
+        if digest is not None:
+            self.hits += 1
+            return digest
+        self.misses += 1
+        digest = hashfile(path)
+        # only cache if the file didn't change while being read
+        if self.__key(os.stat(path)) == self.__key(st):
+            self.put(st, digest)
+        return digest
+
+    def save(self):
+        """
+        Write all pending hashes to disk
+        """
+        with self.__lock:
+            self.__conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [k + (v,) for k, v in self.__pending.items()])
+            self.__conn.commit()
+            self.__pending = {}
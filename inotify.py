@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.inotify
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Minimal ctypes binding to the Linux inotify API
+"""
+
+import os
+import errno
+import struct
+import select
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Inotify',
+    'available',
+]
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the trailing name
+_EVENT = struct.Struct('iIII')
+
+
+def _loadlibc():
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return None
+    if getattr(libc, 'inotify_init1', None) is None:
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_add_watch.restype = ctypes.c_int
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    libc.inotify_rm_watch.restype = ctypes.c_int
+    return libc
+
+_libc = _loadlibc()
+
+
+def available():
+    """
+    Return True if inotify can be used on this system
+    """
+    return _libc is not None
+
+
+def _check(result):
+    if result < 0:
+        import ctypes
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class Inotify(object):
+    """
+    Inotify wraps an inotify file descriptor.
+
+    >>> i = Inotify()
+    >>> wd = i.add_watch('/path/to/dir', IN_CREATE | IN_DELETE)
+    >>> for wd, mask, cookie, name in i.read():
+    ...     print wd, mask, name
+    >>> i.close()
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        """
+        Watch the given path and return its watch descriptor
+        """
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return _check(_libc.inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        try:
+            _check(_libc.inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            # the watch is already gone if its path was deleted
+            if e.errno != errno.EINVAL:
+                raise
+
+    def read(self, timeout=None):
+        """
+        Return a list of (wd, mask, cookie, name) events, waiting
+        up to ``timeout`` seconds (forever if None) for one to arrive
+        """
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        result = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            result.append((wd, mask, cookie, name))
+        return result
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
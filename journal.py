@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.journal
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Append-only journal of a Sync run, used to resume it without a new diff
+"""
+
+import os
+import json
+import time
+import threading
+import logging
+
+import utils
+from diff import Diff
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Journal',
+]
+
+# bump when the file layout changes; older journals are ignored
+VERSION = 3
+
+
+class Journal(object):
+    """
+    Journal records the plan of a Sync run, the Diff being run, followed
+    by the dst path of each item as it finishes. Every line is a JSON
+    value:
+        a header with the src, dst and ops of the run
+        [op, dir, names] for each dir in the diff
+        {"links": [[path, target], ...]} if the diff groups hardlinks
+        {"planned": count} once the whole plan is written
+        "path" for each finished item
+
+    The plan is written to a temp file and renamed into place, so an
+    existing journal is only replaced by a complete one. Finished items
+    are appended and flushed one at a time, so at most the item being
+    written when the process dies is lost. They aren't synced to disk,
+    so a crash of the whole machine can lose more of them, and those
+    items are checked again when the run is resumed.
+
+    >>> j = Journal('/path/to/job.journal')
+    >>> j.start(src, dst, diff, ['create', 'update'])
+    >>> j.done(dstpath)
+    >>> j.close(complete=True)
+    >>> ops, diff = j.load(src, dst)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__file = None
+        self.__lock = threading.Lock()
+
+    def start(self, src, dst, diff, ops):
+        """
+        Write the plan of a run of the given ops of the diff,
+        replacing any earlier journal
+        """
+        self.close()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            header = {'journal':VERSION, 'src':utils._text(src), 'dst':utils._text(dst), 'ops':ops, 'time':time.time()}
+            f.write(json.dumps(header) + '\n')
+            count = 0
+            for op in ops:
+                for dir_, names in getattr(diff, op).items():
+                    if len(names):
+                        f.write(json.dumps([op, utils._text(dir_), utils._text(list(names))]) + '\n')
+                        count += len(names)
+            if diff.hardlinks:
+                links = [utils._text([k, v]) for k, v in sorted(diff.links.items())]
+                f.write(json.dumps({'links':links}) + '\n')
+            f.write(json.dumps({'planned':count}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        self.__file = open(self.path, 'ab')
+
+    def done(self, path):
+        """
+        Record that the item with the given dst path has finished
+        """
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.write(json.dumps(utils._text(path)) + '\n')
+                self.__file.flush()
+
+    def close(self, complete=False):
+        """
+        Stop recording, removing the journal if the run is ``complete``
+        """
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+        if complete and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def load(self, src, dst):
+        """
+        Return the ops and a Diff of the items that haven't finished from
+        a journal of a run between the given src and dst, or None if there
+        isn't a complete plan for them
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return None
+        diff = Diff()
+        diff.src = src
+        diff.dst = dst
+        done = set()
+        planned = False
+        with f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None
+            if (not isinstance(header, dict) or header.get('journal') != VERSION or
+                    utils._native(header.get('src', '')) != src or utils._native(header.get('dst', '')) != dst):
+                return None
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # the last line may be cut short
+                    LOG.debug('Skipping bad journal line: {0!r}'.format(line))
+                    continue
+                if planned:
+                    done.add(utils._native(item))
+                elif isinstance(item, dict) and 'links' in item:
+                    diff.hardlinks = True
+                    diff.links.update(utils._native(link) for link in item['links'])
+                elif isinstance(item, dict):
+                    planned = True
+                else:
+                    op, dir_, names = item
+                    getattr(diff, op).extend(utils._native(dir_), utils._native(names))
+        if not planned:
+            return None
+        # finished items are recorded by dst path
+        srcdone = set()
+        for path in done:
+            rel = os.path.relpath(path, dst)
+            srcdone.add(src if rel == os.curdir else os.path.join(src, rel))
+        diff.trim('create', srcdone)
+        diff.trim('update', srcdone)
+        diff.trim('purge', done)
+        LOG.debug('Loaded journal {0}: {1} items finished, {2} left'.format(self.path, len(done), diff.totalcount))
+        return [str(op) for op in header['ops']], diff
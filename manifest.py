@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.manifest
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Persistent index of directory listings used to speed up repeated diffs
+"""
+
+import os
+import stat
+import time
+import sqlite3
+import threading
+import logging
+
+import utils
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Manifest',
+]
+
+# bump when the table layout changes; older manifests are rebuilt
+VERSION = 5
+
+# directories modified this close to the time they were listed are
+# not trusted, since another change within the same mtime tick would
+# go unnoticed (filesystems like FAT and some SMB shares use 2s ticks)
+RACY = 2.0
+
+
+class Manifest(object):
+    """
+    Manifest records the names in every directory visited by a Diff
+    in a SQLite file, along with the directory's own mtime and the mode
+    of each entry.
+
+    When a directory is listed again and its mtime hasn't changed, the
+    recorded names are used instead of listing the directory. The mtime
+    of a directory only says which names are in it, so each entry is
+    still stat'ed to pick up files that were modified in place. The
+    mtimes of subdirectories come from the stat of their entry in the
+    parent, so directories aren't stat'ed a second time.
+
+    Sync calls ``forget`` on the directories it writes to, so they are
+    listed again by the next diff.
+
+    >>> m = Manifest('/path/to/job.manifest')
+    >>> entries = m.listdir('/path/to/src')
+    >>> m.save()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__forget = {}
+        # mtimes of subdirs taken from the listing of their parent
+        self.__mtimes = {}
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.text_factory = str
+        self.__setup()
+
+    def __setup(self):
+        c = self.__conn
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version != VERSION:
+            c.execute('DROP TABLE IF EXISTS dirs')
+            c.execute('DROP TABLE IF EXISTS entries')
+            c.execute('PRAGMA user_version = {0}'.format(VERSION))
+        c.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                  'path TEXT PRIMARY KEY, mtime REAL, scanned REAL)')
+        c.execute('CREATE TABLE IF NOT EXISTS entries ('
+                  'dir TEXT, name TEXT, mode INTEGER, PRIMARY KEY (dir, name))')
+        c.commit()
+
+    def close(self):
+        self.__conn.close()
+
+    def get(self, path, mtime):
+        """
+        Return entries for the recorded names of the given directory, or
+        None if it isn't recorded or has been modified since. Each entry
+        is stat'ed, so its size and mtime are current.
+        """
+        with self.__lock:
+            row = self.__conn.execute('SELECT mtime, scanned FROM dirs WHERE path=?', (path,)).fetchone()
+            if row is None or row[0] != mtime or mtime >= row[1] - RACY:
+                return None
+            rows = self.__conn.execute('SELECT name FROM entries WHERE dir=?', (path,)).fetchall()
+        result = []
+        for name, in rows:
+            entry = utils._DirEntry(path, name)
+            try:
+                entry.stat(follow_symlinks=False)
+            except OSError:
+                # removed within the same mtime tick, list it again
+                return None
+            result.append(entry)
+        self.__addmtimes(result)
+        return result
+
+    def put(self, path, mtime, entries):
+        """
+        Record the entries of the given directory.
+        The entries are written to disk on ``save``.
+        """
+        rows = []
+        for e in entries:
+            try:
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            rows.append((path, e.name, st.st_mode))
+        self.__addmtimes(entries)
+        with self.__lock:
+            self.__pending[path] = (mtime, time.time(), rows)
+
+    def __addmtimes(self, entries):
+        """
+        Remember the mtimes of the subdirectories among the given
+        entries for when they are listed
+        """
+        mtimes = {}
+        for e in entries:
+            try:
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                mtimes[e.path] = st.st_mtime
+        with self.__lock:
+            self.__mtimes.update(mtimes)
+
+    def forget(self, path, recursive=True):
+        """
+        Remove the given directory from the manifest, along with
+        everything below it if ``recursive`` is True
+        """
+        with self.__lock:
+            self.__forget[path] = self.__forget.get(path, False) or recursive
+
+    def listdir(self, path):
+        """
+        Return the entries of the given directory, using the recorded
+        listing if the directory hasn't changed since it was recorded
+        """
+        with self.__lock:
+            mtime = self.__mtimes.pop(path, None)
+        if mtime is None:
+            mtime = os.stat(path).st_mtime
+        result = self.get(path, mtime)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        with self.__lock:
+            old = self.__conn.execute('SELECT name, mode FROM entries WHERE dir=?', (path,)).fetchall()
+        result = utils._scandir(path)
+        # drop any subdirectories that no longer exist
+        names = set([e.name for e in result])
+        for name, mode in old:
+            if stat.S_ISDIR(mode) and name not in names:
+                self.forget(os.path.join(path, name))
+        self.put(path, mtime, result)
+        return result
+
+    def save(self):
+        """
+        Write all pending listings to disk
+        """
+        with self.__lock:
+            c = self.__conn
+            for path, recursive in self.__forget.items():
+                if not recursive:
+                    c.execute('DELETE FROM dirs WHERE path=?', (path,))
+                    c.execute('DELETE FROM entries WHERE dir=?', (path,))
+                    continue
+                # everything that starts with path + sep
+                lo = path.rstrip('/\\') + os.sep
+                hi = lo[:-1] + chr(ord(os.sep) + 1)
+                c.execute('DELETE FROM dirs WHERE path=? OR (path>=? AND path<?)', (path, lo, hi))
+                c.execute('DELETE FROM entries WHERE dir=? OR (dir>=? AND dir<?)', (path, lo, hi))
+            for path, (mtime, scanned, rows) in self.__pending.items():
+                c.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, mtime, scanned))
+                c.execute('DELETE FROM entries WHERE dir=?', (path,))
+                c.executemany('INSERT INTO entries VALUES (?, ?, ?)', rows)
+            c.commit()
+            LOG.debug('saved {0} listings to manifest: {1}'.format(len(self.__pending), self.path))
+            self.__pending = {}
+            self.__forget = {}
+            self.__mtimes = {}
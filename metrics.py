@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.metrics
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Timing and throughput metrics collected by Diff and Sync
+"""
+
+import json
+import heapq
+import threading
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Histogram',
+    'Metrics',
+]
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['{0}="{1}"'.format(k, _escape(v)) for k, v in sorted(labels.items())]) + '}'
+
+
+class Histogram(object):
+    """
+    Histogram counts observed durations in fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def todict(self):
+        return {
+            'buckets':dict([(str(b), c) for b, c in zip(self.buckets, self.counts)] +
+                           [('+Inf', self.counts[-1])]),
+            'count':self.count,
+            'sum':self.sum,
+        }
+
+
+class Metrics(object):
+    """
+    Metrics accumulates the time spent in each phase of a sync, counters
+    such as the number of bytes copied, latency histograms of single
+    operations and the slowest directories to compare. Everything is
+    cumulative, so one instance can be shared by all the syncs of a
+    long running watch and scraped at any time.
+
+    Access is thread safe so it can be updated from worker threads.
+
+    >>> m = Metrics()
+    >>> m.addtime('create', 1.5)
+    >>> m.observe('copy', 0.02)
+    >>> print m.toprometheus()
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.__dirs = []
+        self.__lock = threading.Lock()
+
+    def addtime(self, phase, seconds):
+        """
+        Add to the time spent in the given phase
+        """
+        with self.__lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """
+        Add the duration of a single operation to the named histogram
+        """
+        with self.__lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def dir(self, path, seconds, entries=0):
+        """
+        Record the time it took to compare a directory,
+        keeping only the ``slowest`` ones
+        """
+        with self.__lock:
+            item = (seconds, path, entries)
+            if len(self.__dirs) < self.slowest:
+                heapq.heappush(self.__dirs, item)
+            elif item > self.__dirs[0]:
+                heapq.heapreplace(self.__dirs, item)
+
+    def slowestdirs(self):
+        """
+        Return a list of (seconds, path, entries) for the slowest
+        directories, slowest first
+        """
+        with self.__lock:
+            return sorted(self.__dirs, reverse=True)
+
+    def todict(self):
+        with self.__lock:
+            result = {
+                'phases':dict(self.phases),
+                'counters':dict(self.counters),
+                'histograms':dict((k, v.todict()) for k, v in self.histograms.items()),
+            }
+        result['slowestdirs'] = [{'path':p, 'seconds':s, 'entries':e}
+                                 for s, p, e in self.slowestdirs()]
+        return result
+
+    def tojson(self, **kwargs):
+        return json.dumps(self.todict(), **kwargs)
+
+    def toprometheus(self, prefix='filesync', labels=None):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        ``labels`` -- a dict of labels added to every sample
+        """
+        labels = labels or {}
+        lines = []
+        def sample(name, value, extra=None):
+            l = dict(labels)
+            l.update(extra or {})
+            lines.append('{0}{1} {2}'.format(name, _labels(l), repr(float(value))))
+
+        data = self.todict()
+        name = '{0}_phase_seconds_total'.format(prefix)
+        lines.append('# HELP {0} Time spent in each phase of the sync.'.format(name))
+        lines.append('# TYPE {0} counter'.format(name))
+        for phase, seconds in sorted(data['phases'].items()):
+            sample(name, seconds, {'phase':phase})
+        for counter, value in sorted(data['counters'].items()):
+            name = '{0}_{1}_total'.format(prefix, counter)
+            lines.append('# TYPE {0} counter'.format(name))
+            sample(name, value)
+        for hist, values in sorted(self.__histograms().items()):
+            name = '{0}_{1}_seconds'.format(prefix, hist)
+            lines.append('# HELP {0} Latency of single {1} operations.'.format(name, hist))
+            lines.append('# TYPE {0} histogram'.format(name))
+            total = 0
+            for bound, count in zip(values.buckets, values.counts):
+                total += count
+                sample(name + '_bucket', total, {'le':repr(bound)})
+            sample(name + '_bucket', values.count, {'le':'+Inf'})
+            sample(name + '_sum', values.sum)
+            sample(name + '_count', values.count)
+        name = '{0}_slow_dir_seconds'.format(prefix)
+        lines.append('# HELP {0} Time taken to compare the slowest directories.'.format(name))
+        lines.append('# TYPE {0} gauge'.format(name))
+        for item in data['slowestdirs']:
+            sample(name, item['seconds'], {'dir':item['path']})
+        return '\n'.join(lines) + '\n'
+
+    def __histograms(self):
+        with self.__lock:
+            result = {}
+            for k, v in self.histograms.items():
+                copy = Histogram(v.buckets)
+                copy.counts = list(v.counts)
+                copy.count = v.count
+                copy.sum = v.sum
+                result[k] = copy
+            return result
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.progress
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Byte weighted progress of a sync
+"""
+
+import math
+import time
+import threading
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Progress',
+]
+
+
+class Progress(object):
+    """
+    Progress tracks how much of a sync is done, weighting each item by
+    its size in bytes plus ``ITEMCOST`` for the work done per item
+    regardless of its size, so dirs, deletes and empty files still count.
+
+    ``add`` returns True when a report is due, which is at most every
+    ``interval`` seconds, or whenever another ``quantum`` bytes are done
+    if it is set. An interval of 0 reports every item.
+
+    The rate is a moving average of the weighted bytes done per second
+    over about the last ``window`` seconds, and the ETA is worked out
+    from it. If the total isn't known (0), the percent is 0 and there
+    is no ETA.
+
+    Access is thread safe so items can be added from copy workers.
+
+    >>> p = Progress(interval=0.5)
+    >>> p.start(totalbytes=1024 ** 3, totalitems=100)
+    >>> if p.add(4096):
+    ...     print p.percent(), p.rate(), p.eta()
+    """
+
+    # bytes each item counts for on top of its size
+    ITEMCOST = 4096
+
+    def __init__(self, interval=0.5, quantum=0, window=5.0):
+        self.interval = interval
+        self.quantum = quantum
+        self.window = window
+        self.__lock = threading.Lock()
+        self.start()
+
+    def start(self, totalbytes=0, totalitems=0):
+        """
+        Reset the progress for a run of the given size
+        """
+        now = time.time()
+        with self.__lock:
+            self.total = totalbytes + totalitems * self.ITEMCOST
+            self.done = 0
+            self.items = 0
+            self.stime = now
+            self.__rate = None
+            self.__sample = (now, 0)
+            self.__reported = (now, 0)
+
+    def add(self, nbytes=0, items=1):
+        """
+        Add finished items of ``nbytes`` in total, returning
+        True if a report is due
+        """
+        now = time.time()
+        with self.__lock:
+            self.done += nbytes + items * self.ITEMCOST
+            self.items += items
+            self.__update(now)
+            last, lastdone = self.__reported
+            if (now - last < self.interval and
+                    not (self.quantum and self.done - lastdone >= self.quantum)):
+                return False
+            self.__reported = (now, self.done)
+            return True
+
+    def __update(self, now):
+        """
+        Fold the work done since the last sample into the moving average
+        """
+        last, lastdone = self.__sample
+        elapsed = now - last
+        if elapsed <= 0:
+            return
+        rate = (self.done - lastdone) / elapsed
+        if self.__rate is None:
+            self.__rate = rate
+        else:
+            alpha = 1 - math.exp(-elapsed / self.window) if self.window > 0 else 1
+            self.__rate += alpha * (rate - self.__rate)
+        self.__sample = (now, self.done)
+
+    def percent(self):
+        if not self.total:
+            return 0.0
+        return min(100.0, float(self.done) / self.total * 100)
+
+    def rate(self):
+        """
+        Return the moving average of the weighted bytes done per second
+        """
+        with self.__lock:
+            if self.__rate is not None:
+                return self.__rate
+            elapsed = time.time() - self.stime
+            return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """
+        Return the estimated seconds left, or None if it isn't known
+        """
+        rate = self.rate()
+        if not self.total or rate <= 0:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.purge
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Parallel removal of directory trees used by Sync
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+import Queue
+import itertools
+import threading
+import collections
+import logging
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'Purger',
+]
+
+# errors from unlinking a name that turns out to be a directory
+# (EPERM on macOS, EACCES on windows)
+_ISDIR = set([errno.EISDIR, errno.EPERM, errno.EACCES])
+
+_O_DIRECTORY = getattr(os, 'O_DIRECTORY', None)
+_DIRFD = hasattr(os, 'supports_dir_fd') and os.unlink in os.supports_dir_fd
+_LISTFD = hasattr(os, 'scandir') and os.scandir in getattr(os, 'supports_fd', ())
+
+
+def _loadunlinkat():
+    """
+    Return unlinkat from libc loaded through ctypes, or None if it isn't available
+    """
+    try:
+        import ctypes
+        fnc = ctypes.CDLL(None, use_errno=True).unlinkat
+    except (ImportError, OSError, AttributeError):
+        return None
+    fnc.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    fnc.restype = ctypes.c_int
+    return fnc
+
+_libcunlinkat = None
+if not _DIRFD and _O_DIRECTORY is not None:
+    _libcunlinkat = _loadunlinkat()
+
+
+def _opendir(path):
+    """
+    Return a descriptor of the given dir for unlinking names relative
+    to it, or None if that isn't supported
+    """
+    if _O_DIRECTORY is None or not (_DIRFD or _libcunlinkat):
+        return None
+    return os.open(path, os.O_RDONLY | _O_DIRECTORY | getattr(os, 'O_NOFOLLOW', 0))
+
+def _listdir(fd, path):
+    """
+    Return a list of (name, isdir) for the given dir, isdir is None if
+    the type isn't known without a stat. Without a descriptor of the dir
+    each name is lstat'ed, since names are unlinked by path and that
+    can fail for reasons that look the same as unlinking a dir.
+    """
+    if fd is not None and _LISTFD:
+        result = []
+        for e in os.scandir(fd):
+            try:
+                result.append((e.name, e.is_dir(follow_symlinks=False)))
+            except OSError:
+                result.append((e.name, None))
+        return result
+    if fd is not None:
+        return [(name, None) for name in os.listdir(path)]
+    result = []
+    for name in os.listdir(path):
+        try:
+            isdir = stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode)
+        except OSError:
+            isdir = None
+        result.append((name, isdir))
+    return result
+
+def _unlinkat(fd, path, name):
+    if fd is None:
+        os.unlink(os.path.join(path, name))
+    elif _DIRFD:
+        os.unlink(name, dir_fd=fd)
+    else:
+        import ctypes
+        if not isinstance(name, bytes):
+            name = name.encode(sys.getfilesystemencoding())
+        if _libcunlinkat(fd, name, 0) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), os.path.join(path, name))
+
+
+class _Node(object):
+    """
+    A dir being removed, which is removed itself once
+    ``remaining`` of its subdirs are gone
+    """
+    __slots__ = ('path', 'parent', 'tree', 'remaining', 'failed')
+
+    def __init__(self, path, parent, tree):
+        self.path = path
+        self.parent = parent
+        self.tree = tree
+        self.remaining = 0
+        self.failed = False
+
+
+class _Tree(object):
+    """
+    The state of one ``Purger.rmtree`` call
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.done = threading.Event()
+
+
+class Purger(object):
+    """
+    Purger removes directory trees on a pool of ``workers`` threads,
+    each listing one dir at a time and unlinking its files relative to
+    a descriptor of the dir (dir_fd or unlinkat), so the path is only
+    resolved once per dir instead of once per file. Dirs are removed as
+    soon as everything in them is gone. With a single worker the tree
+    is removed on the calling thread.
+
+    If ``trash`` is set, ``remove`` renames trees into that dir instead
+    and returns straight away, and a background thread deletes them.
+    The trash dir must be on the same filesystem as the trees, and
+    outside of any tree being synced; trees that can't be renamed into
+    it are removed in place. Anything left in the trash from earlier
+    runs is deleted as well.
+
+    >>> p = Purger(workers=8, trash='/mnt/shots/.trash')
+    >>> p.remove('/mnt/shots/old')
+    >>> p.wait()
+    """
+
+    def __init__(self, workers=1, trash=None):
+        self.workers = max(1, workers or 1)
+        self.trash = os.path.normpath(trash) if trash else None
+        self.__lock = threading.Lock()
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        self.__trashed = None
+        self.__names = itertools.count()
+
+    def remove(self, path):
+        """
+        Remove the given dir, or move it to the trash if there is one.
+        Raises OSError if it couldn't be removed.
+        """
+        if self.trash is not None:
+            dst = self.__totrash(path)
+            if dst is not None:
+                self.__trashed.put(dst)
+                return
+        self.rmtree(path)
+
+    def rmtree(self, path):
+        """
+        Remove the given dir and everything in it, raising the
+        first OSError after removing as much as possible.
+        A symlink to a dir is refused, like shutil.rmtree.
+        """
+        if os.path.islink(path):
+            raise OSError(errno.ENOTDIR, 'Cannot remove a symlink to a dir', path)
+        tree = _Tree()
+        root = _Node(os.path.normpath(path), None, tree)
+        if self.workers > 1:
+            self.__start()
+            self.__queue.put(root)
+            tree.done.wait()
+        else:
+            pending = collections.deque([root])
+            while pending:
+                pending.extend(self.__scan(pending.popleft()))
+        if tree.errors:
+            raise tree.errors[0]
+
+    def wait(self):
+        """
+        Block until everything moved to the trash has been deleted
+        """
+        if self.__trashed is not None:
+            self.__trashed.join()
+
+    def close(self):
+        """
+        Wait for the trash to be deleted and stop the worker threads
+        """
+        self.wait()
+        with self.__lock:
+            threads, self.__threads = self.__threads, []
+        for t in threads:
+            self.__queue.put(None)
+        for t in threads:
+            t.join()
+
+    def __start(self):
+        with self.__lock:
+            while len(self.__threads) < self.workers:
+                t = threading.Thread(target=self.__work)
+                t.daemon = True
+                t.start()
+                self.__threads.append(t)
+
+    def __work(self):
+        while True:
+            node = self.__queue.get()
+            if node is None:
+                return
+            try:
+                for child in self.__scan(node):
+                    self.__queue.put(child)
+            except Exception as e:
+                LOG.exception('Exception in purge thread')
+                node.tree.errors.append(e)
+                node.tree.done.set()
+
+    def __scan(self, node):
+        """
+        Unlink everything but the subdirs of the given dir and return a node
+        for each subdir. The dir itself is removed if it has none left.
+        """
+        subdirs = []
+        try:
+            fd = _opendir(node.path)
+            try:
+                for name, isdir in _listdir(fd, node.path):
+                    if isdir:
+                        subdirs.append(name)
+                        continue
+                    try:
+                        _unlinkat(fd, node.path, name)
+                    except OSError as e:
+                        if isdir is None and e.errno in _ISDIR:
+                            subdirs.append(name)
+                        elif e.errno != errno.ENOENT:
+                            self.__fail(node, e)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        except OSError as e:
+            self.__fail(node, e)
+        node.remaining = len(subdirs)
+        if not subdirs:
+            self.__rmdir(node)
+        return [_Node(os.path.join(node.path, name), node, node.tree) for name in subdirs]
+
+    def __fail(self, node, e):
+        with self.__lock:
+            node.failed = True
+            node.tree.errors.append(e)
+
+    def __rmdir(self, node):
+        """
+        Remove the given dir once everything in it is gone,
+        followed by any parents that are now empty
+        """
+        while node is not None:
+            if not node.failed:
+                try:
+                    os.rmdir(node.path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        self.__fail(node, e)
+            parent = node.parent
+            if parent is None:
+                node.tree.done.set()
+                return
+            with self.__lock:
+                parent.failed = parent.failed or node.failed
+                parent.remaining -= 1
+                if parent.remaining:
+                    return
+            node = parent
+
+    def __totrash(self, path):
+        """
+        Move the given dir into the trash and return its new path,
+        or None if it couldn't be moved
+        """
+        self.__starttrash()
+        name = '{0}.{1}.{2}.{3}'.format(os.path.basename(os.path.normpath(path)),
+                                        int(time.time()), os.getpid(), next(self.__names))
+        dst = os.path.join(self.trash, name)
+        try:
+            os.rename(path, dst)
+        except OSError as e:
+            LOG.debug('Could not move {0} to the trash: {1}'.format(path, e))
+            return None
+        return dst
+
+    def __starttrash(self):
+        """
+        Start the thread that deletes the trash, queuing anything
+        left in it from earlier runs
+        """
+        with self.__lock:
+            if self.__trashed is not None:
+                return
+            self.__trashed = Queue.Queue()
+        try:
+            if not os.path.isdir(self.trash):
+                os.makedirs(self.trash)
+            for name in os.listdir(self.trash):
+                self.__trashed.put(os.path.join(self.trash, name))
+        except OSError as e:
+            LOG.warning('Could not read the trash {0}: {1}'.format(self.trash, e))
+        t = threading.Thread(target=self.__empty)
+        t.daemon = True
+        t.start()
+
+    def __empty(self):
+        """
+        Thread: delete everything moved to the trash
+        """
+        while True:
+            path = self.__trashed.get()
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    self.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                LOG.warning('Could not delete {0} from the trash: {1}'.format(path, e))
+            except Exception:
+                LOG.exception('Exception deleting the trash')
+            finally:
+                self.__trashed.task_done()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.report
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Writers that stream Diff and Sync reports to a file
+"""
+
+import os
+import csv
+import json
+import logging
+
+import utils
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'CSVWriter',
+    'JSONLinesWriter',
+    'ReportWriter',
+    'TextWriter',
+    'WRITERS',
+    'writer',
+]
+
+
+class ReportWriter(object):
+    """
+    ReportWriter writes a report to the file-like ``out`` as it is
+    generated, so nothing but the current line is held in memory.
+
+    A report is a ``header`` followed by a ``section`` with the count
+    of each op, and the items of the section unless ``summary`` is True.
+    Items are either a ``path`` or a ``name`` in the dir ``path``.
+    ``status`` is 'pass' or 'fail' for the results of a run, and None
+    for the items of a diff.
+    """
+
+    def __init__(self, out, summary=False):
+        self.out = out
+        self.summary = summary
+
+    def header(self, title, src, dst):
+        pass
+
+    def section(self, op, count, status=None):
+        pass
+
+    def item(self, op, path, name=None, status=None):
+        pass
+
+    def close(self):
+        if hasattr(self.out, 'flush'):
+            self.out.flush()
+
+
+class TextWriter(ReportWriter):
+    """
+    Writes the indented text layout that is logged by default
+    """
+
+    LABELS = {None:'', 'pass':' Passes', 'fail':' Fails'}
+
+    def __init__(self, out, summary=False):
+        super(TextWriter, self).__init__(out, summary)
+        self.__dir = None
+
+    def header(self, title, src, dst):
+        self.out.write('\n{0}\n{1}\n'.format(title, '-' * len(title)))
+
+    def section(self, op, count, status=None):
+        if status != 'fail':
+            self.out.write('\n')
+        self.out.write('{0}{1}: ({2})\n'.format(op.title(), self.LABELS[status], count))
+        self.__dir = None
+
+    def item(self, op, path, name=None, status=None):
+        if name is None:
+            self.out.write('  {0}\n'.format(path))
+            return
+        if path != self.__dir:
+            self.out.write('  {0}{1}\n'.format(path, os.sep))
+            self.__dir = path
+        self.out.write('    {0}\n'.format(name))
+
+
+class JSONLinesWriter(ReportWriter):
+    """
+    Writes one JSON object per line, with a ``type`` of 'report',
+    'summary' or 'item'. Paths are written as text through latin-1
+    (see utils._text), so names that aren't valid UTF-8 can be written.
+
+    >>> import sys
+    >>> JSONLinesWriter(sys.stdout).item('copy', '/src/caf\\xe9')
+    {"op": "copy", "path": "/src/caf\\u00e9", "type": "item"}
+    """
+
+    def __write(self, record):
+        self.out.write(json.dumps(record, sort_keys=True))
+        self.out.write('\n')
+
+    def header(self, title, src, dst):
+        self.__write({'type':'report', 'title':utils._text(title),
+                      'src':utils._text(src), 'dst':utils._text(dst)})
+
+    def section(self, op, count, status=None):
+        record = {'type':'summary', 'op':op, 'count':count}
+        if status is not None:
+            record['status'] = status
+        self.__write(record)
+
+    def item(self, op, path, name=None, status=None):
+        path = path if name is None else os.path.join(path, name)
+        record = {'type':'item', 'op':op, 'path':utils._text(path)}
+        if status is not None:
+            record['status'] = status
+        self.__write(record)
+
+
+class CSVWriter(ReportWriter):
+    """
+    Writes a header row of ``FIELDS`` followed by one row
+    for each summary and item
+    """
+
+    FIELDS = ('type', 'op', 'status', 'path', 'count')
+
+    def __init__(self, out, summary=False):
+        super(CSVWriter, self).__init__(out, summary)
+        self.__csv = csv.writer(out)
+
+    def header(self, title, src, dst):
+        self.__csv.writerow(self.FIELDS)
+
+    def section(self, op, count, status=None):
+        self.__csv.writerow(('summary', op, status or '', '', count))
+
+    def item(self, op, path, name=None, status=None):
+        path = path if name is None else os.path.join(path, name)
+        self.__csv.writerow(('item', op, status or '', path, ''))
+
+
+WRITERS = {
+    'text':TextWriter,
+    'jsonl':JSONLinesWriter,
+    'csv':CSVWriter,
+}
+
+
+def writer(out, format='text', summary=False):
+    """
+    Return a writer of the given format, one of ``WRITERS``
+    """
+    if format not in WRITERS:
+        raise ValueError('unknown report format: {0}'.format(format))
+    return WRITERS[format](out, summary)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.statcache
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Cache of directory entries shared by the diff and sync phases
+"""
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+import utils
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'StatCache',
+]
+
+
+class StatCache(object):
+    """
+    StatCache keeps the directory entries found by a Diff so the Sync
+    that runs it can look up the same paths without stat'ing them again.
+    Entries cache their own stat results, and the type of entries that
+    came from a directory listing is known without a stat at all.
+
+    At most ``maxsize`` entries are kept, dropping the least recently
+    used ones first. Nothing is checked against the disk once cached,
+    so anything that changes a path must ``invalidate`` it. Lookups of
+    paths that aren't cached stat them and cache the result, and are
+    counted in ``misses``, while lookups that are served from the cache
+    are counted in ``hits``.
+
+    The time taken by each stat of a miss is recorded in ``metrics``
+    (see metrics.Metrics) if it is set.
+
+    Access is thread safe so it can be shared with copy workers.
+
+    >>> c = StatCache()
+    >>> c.put(entry)
+    >>> c.isdir(entry.path)
+    >>> c.invalidate(entry.path)
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.metrics = None
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __key(self, path):
+        return os.path.normpath(path)
+
+    def put(self, entry):
+        """
+        Cache the given directory entry under its path
+        """
+        if not self.maxsize or self.maxsize <= 0:
+            return
+        key = self.__key(entry.path)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = entry
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def entry(self, path):
+        """
+        Return the cached entry for the given path, or a new one
+        if it isn't cached. Raises OSError if the path doesn't exist.
+        """
+        key = self.__key(path)
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = utils._entry(key)
+        start = time.time()
+        try:
+            entry.stat()
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('stat', time.time() - start)
+        self.put(entry)
+        return entry
+
+    def peek(self, path):
+        """
+        Return the cached entry for the given path, or None if it isn't
+        cached, without counting a lookup or marking it as recently used
+        """
+        with self.__lock:
+            return self.__entries.get(self.__key(path))
+
+    def stat(self, path):
+        """
+        Return the stat result of the given path, following symlinks
+        """
+        return self.entry(path).stat()
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return self.entry(path).is_dir()
+        except OSError:
+            return False
+
+    def isfile(self, path):
+        try:
+            return self.entry(path).is_file()
+        except OSError:
+            return False
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drop the given path from the cache, along with
+        everything inside it if ``recursive`` is True
+        """
+        key = self.__key(path)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            if recursive:
+                prefix = os.path.join(key, '')
+                for k in [k for k in self.__entries if k.startswith(prefix)]:
+                    del self.__entries[k]
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
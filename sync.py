@@ -9,9 +9,22 @@ Copyright (c) 2012 Moonbot Studios. All rights reserved.
 
 import os, stat, re, time, sys
 import shutil, filecmp
+import Queue
 import logging
+import sqlite3
+import threading
+from cStringIO import StringIO
 
+import utils
+import transfer
 from diff import Diff
+from manifest import Manifest
+from statcache import StatCache
+from metrics import Metrics
+from progress import Progress
+from purge import Purger
+from journal import Journal
+import report as _report
 from utils import *
 
 try:
@@ -21,7 +34,7 @@ try:
 except:
     import logging
     LOG = logging.getLogger(__name__)
-    ROOTLOG = mbotenv.get_logger()
+    ROOTLOG = logging.getLogger()
     ROOTLOG.indent = 0
 
 __all__ = [
@@ -47,6 +60,81 @@ class Sync(object):
     desired changes, run the ``sync`` or ``update`` methods depending on if
     files/dirs should be created and updated, or only updated.
 
+    Setting the ``copyWorkers`` run setting above 1 copies files on a pool
+    of threads. Directories are still created in order on the calling
+    thread before any of their files are queued.
+
+    The ``copyStrategy`` run setting picks how file data is copied (see
+    transfer.STRATEGIES), by default the kernel copies files directly with
+    copy_file_range or sendfile where possible. The strategy used for each
+    file is recorded in ``stats['copystrategies']``.
+
+    When the strategy is 'auto' or 'reflink', files are first cloned with
+    a reflink (see transfer.reflink), which shares their data instead of
+    copying it on copy on write filesystems like btrfs and XFS. Where
+    that isn't supported, files are copied as below.
+
+    Updated files of at least ``deltaLimit`` KB only have the blocks that
+    changed rewritten into a reflink of dst that then replaces it (see
+    transfer.deltacopy), and the bytes that didn't need to be written are
+    recorded in ``stats['deltasaved']``. This needs a filesystem that
+    supports reflinks, like btrfs or XFS; elsewhere the files are copied
+    in full as below, and this is logged once.
+
+    Files of at least ``resumeLimit`` KB are copied with a resumable copy
+    (see transfer.resumablecopy), so a copy that is interrupted carries
+    on where it left off in the next run instead of starting over. The
+    bytes that were already copied are recorded in ``stats['resumed']``.
+    Sparse files are copied as below instead, since a resumable copy
+    writes out their holes.
+
+    Sparse files are copied without reading or writing their holes if
+    ``sparse`` is True (see transfer.sparsecopy), and the size of the
+    holes skipped is recorded in ``stats['sparsesaved']``. The bytes
+    actually written are counted in ``stats['bytescopied']``, and the
+    full size of the files copied in ``stats['logicalbytes']``.
+
+    With the ``hardlinks`` diff setting, files with more than one link
+    are held back until the rest of the run is done. The first file of
+    each group (see Diff.links) is then copied, and the rest are
+    hardlinked to its dst instead of being copied. They are recorded in
+    ``stats['hardlinks']`` with the file they are linked to, and are
+    copied as usual if that file wasn't copied or can't be linked to.
+
+    The entries found by ``diff`` are kept in ``statcache`` (see
+    statcache.StatCache) so the run doesn't stat them again. Up to
+    ``statCacheSize`` entries are kept per diff, and the cache hits and
+    misses of the last run are recorded in ``stats['statcache']``.
+
+    ``stream`` combines ``diff`` and ``run``, copying files while the
+    trees are still being compared.
+
+    The time spent in each phase of the last run is recorded in
+    ``stats['phases']`` along with its throughput. ``metrics`` (see
+    metrics.Metrics) accumulates these over every run of the Sync with
+    latency histograms and the slowest directories, and can be exported
+    as JSON or in the Prometheus text format.
+
+    ``progressfnc`` is called with a message and the percent done at most
+    every ``progressInterval`` milliseconds, or whenever another
+    ``progressQuantum`` KB are copied if it is set. The percent is
+    weighted by the size of the files in the diff being run, as far as
+    they are known from ``statcache``, and
+    ``progress`` (see progress.Progress) also has the current rate
+    and ETA.
+
+    Purged dirs are removed by ``purger`` (see purge.Purger) on
+    ``purgeWorkers`` threads. If ``purgeTrash`` is set they are moved
+    into that dir instead, and deleted in the background while the run
+    carries on. It must be on the same filesystem as dst, but not
+    inside it. Call ``purger.wait()`` to wait for the trash to be empty.
+
+    If the ``journal`` run setting is a file path, the diff being run
+    and each item as it finishes are recorded in that file (see
+    journal.Journal). If the run is interrupted, ``resume`` carries on
+    with the items that are left without running a new diff. The file
+    is removed once a run completes.
+
     TODO: describe the diff settings and run settings here
     """
     
@@ -67,6 +155,14 @@ class Sync(object):
             'newer':True,
             'forceUpdate':False,
             'sizeLimit':0,
+            'scanWorkers':1,
+            'manifest':None,
+            'checksum':False,
+            'hashstore':None,
+            'hashWorkers':4,
+            'dirlist':[],
+            'pruneExcludes':True,
+            'hardlinks':False,
         }
         self.runstngs = {
             'maketarget':True,
@@ -76,10 +172,38 @@ class Sync(object):
             'purge':False,
             'forceOwnership':False,
             'errorsToDebug':False,
+            'copyWorkers':1,
+            'copyStrategy':'auto',
+            'deltaLimit':0,
+            'resumeLimit':0,
+            'sparse':True,
+            'streamBacklog':1000,
+            'statCacheSize':100000,
+            'progressInterval':500,
+            'progressQuantum':0,
+            'purgeWorkers':1,
+            'purgeTrash':'',
+            'journal':'',
         }
         self.progressfnc = None
         self.progresscheck = None
         self.progressamt = 0
+        self.progress = Progress()
+        self.__sizes = None
+        self.purger = None
+        self.__journal = None
+        self.__stopped = False
+        self.__lock = threading.Lock()
+        self.__pool = None
+        self.__linkdiff = None
+        self.__linkqueue = []
+        self.__touched = {}
+        self.__streaming = False
+        self.statcache = StatCache()
+        self.metrics = Metrics()
+        self.__phase = None
+        self.__difftime = 0.0
+        self.__nodelta = False
         
         self.stats = {
             'stime':0.0,
@@ -90,6 +214,18 @@ class Sync(object):
             'updatefails':[],
             'purges':[],
             'purgefails':[],
+            'copystrategies':{},
+            'deltasaved':{},
+            'resumed':{},
+            'sparsesaved':{},
+            'hardlinks':{},
+            'statcache':{},
+            'phases':{},
+            'bytescopied':0,
+            'logicalbytes':0,
+            'filespersec':0.0,
+            'mbpersec':0.0,
+            'metrics':{},
         }
         self.__hasrun = False
         self.__hasrundiff = False
@@ -124,25 +260,39 @@ class Sync(object):
         if self.__validate():
             # TODO: filter kwargs
             self.diffstngs.update(kwargs)
-            self.origdiff = Diff(self.src, self.dst, **self.diffstngs)
+            self.__resetcache()
+            start = time.time()
+            self.origdiff = Diff(self.src, self.dst, statcache=self.statcache,
+                                 metrics=self.metrics, **self.diffstngs)
+            self.__difftime = time.time() - start
+            self.metrics.addtime('diff', self.__difftime)
             self.trimdiff = self.origdiff.copy()
             self.__hasrundiff = True
             self.__diffcurrent = True
     
-    def difftrim(self, create=[], update=[], purge=[]):
+    def __resetcache(self):
+        """
+        Start a new cycle with an empty stat cache
+        """
+        self.statcache.maxsize = self.runstngs['statCacheSize']
+        self.statcache.metrics = self.metrics
+        self.statcache.clear()
+
+    def difftrim(self, create=[], update=[], purge=[], prefixes=None, predicate=None):
         """
         Removes items from ``origdiff`` and saves the results in ``trimdiff``
         
         ``create`` -- a list of full paths to remove from the create diff list
         ``update`` -- a list of full paths to remove from the update diff list
         ``purge`` -- a list of full paths to remove from the purge diff list
+        ``prefixes`` -- full dir paths to remove from all diff lists along
+            with everything in them
+        ``predicate`` -- a function called with each full path in the diff
+            lists, returning True if it should be removed (see Diff.trim)
         """
-        for path in create:
-            self.trimdiff.remove_create(path)
-        for path in update:
-            self.trimdiff.remove_update(path)
-        for path in purge:
-            self.trimdiff.remove_purge(path)
+        self.trimdiff.trim('create', create, prefixes, predicate)
+        self.trimdiff.trim('update', update, prefixes, predicate)
+        self.trimdiff.trim('purge', purge, prefixes, predicate)
 
     def sync(self, refreshDiff=False, dry_run=False, **kwargs):
         """
@@ -180,6 +330,7 @@ class Sync(object):
             self.stats['stime'] = time.time()
             self.__run(dry_run=dry_run)
             self.stats['etime'] = time.time()
+            self.__finishstats()
             
             self.__hasrun = True
             self.__diffcurrent = False
@@ -188,103 +339,530 @@ class Sync(object):
         except:
             LOG.exception("Exception running filesync")
     
+    def stream(self, dry_run=False, **kwargs):
+        """
+        Diff and run in one pass. The diff is walked on a separate thread
+        and each item is executed as soon as it's found, instead of waiting
+        for the whole diff like ``diff`` followed by ``run``. At most
+        ``streamBacklog`` items are held between the two, so memory use
+        doesn't depend on the size of the trees (see Diff.events).
+
+        ``origdiff`` and ``trimdiff`` are not used, so nothing can be
+        trimmed, and progress is reported as 0 percent since the total
+        isn't known up front. Purged dirs are removed after the walk
+        has finished, since it may still be listing them.
+        """
+        try:
+            self.runstngs.update(kwargs)
+            self.stats['stime'] = time.time()
+            self.__streaming = True
+            self.__stopped = False
+            self.__resetstats()
+            self.__withpool(self.__runstream, dry_run)
+            self.stats['etime'] = time.time()
+            self.__finishstats()
+            self.__hasrun = True
+        except:
+            LOG.exception("Exception running filesync")
+        finally:
+            self.__streaming = False
+
+    def __runstream(self, dry_run=False):
+        self.__resetcache()
+        self.__setphase('stream')
+        self.__startprogress()
+        d = Diff(statcache=self.statcache, metrics=self.metrics, **self.diffstngs)
+        d.src = self.src
+        d.dst = self.dst
+        self.__startlinks(d)
+        events = Queue.Queue(max(self.runstngs['streamBacklog'], 1))
+        stop = threading.Event()
+        t = threading.Thread(target=self.__produce, args=(d.events(), events, stop))
+        t.daemon = True
+        t.start()
+        ops = [op for op in self.ops if self.runstngs[op]]
+        purgedirs = set()
+        lastdir = None
+        made = None
+        try:
+            while True:
+                item = events.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                op, dir_, name = item
+                if op not in ops:
+                    continue
+                if dir_ != lastdir:
+                    if not self.__checkprogress():
+                        return
+                    lastdir = dir_
+                if op == 'purge':
+                    dstp = os.path.join(dir_, name)
+                    # skip anything inside a dir that will be removed
+                    parent = dir_
+                    while parent not in purgedirs and len(parent) > len(self.dst):
+                        parent = os.path.dirname(parent)
+                    if parent in purgedirs:
+                        continue
+                    if name.endswith(os.sep):
+                        purgedirs.add(os.path.normpath(dstp))
+                    else:
+                        self.__purge(dstp, dry_run)
+                    continue
+                relpath = os.path.relpath(dir_, self.src)
+                if relpath == '.':
+                    relpath = ''
+                srcdir = os.path.join(self.src, relpath)
+                dstdir = os.path.join(self.dst, relpath)
+                if op == 'create':
+                    # make the destination dir if it doesn't exist
+                    if dstdir != made and not self.statcache.isdir(dstdir):
+                        self.__makedirs(dstdir, self.stats['creates'], self.stats['createfails'], dry_run)
+                    made = dstdir
+                    self.__create(os.path.join(srcdir, name), os.path.join(dstdir, name), dry_run)
+                else:
+                    self.__update(os.path.join(srcdir, name), os.path.join(dstdir, name), dry_run)
+            self.__wait()
+            if not self.__runlinks(dry_run):
+                return
+            for dstp in sorted(purgedirs):
+                self.__purge(dstp, dry_run)
+        finally:
+            stop.set()
+        if self.progressfnc:
+            self.progressfnc("Sync Complete", 100)
+
+    def __produce(self, events, queue, stop):
+        """
+        Thread: put every item from the ``events`` generator on the queue,
+        followed by None, or the exception if it failed
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        try:
+            for event in events:
+                if not put(event):
+                    return
+        except Exception as e:
+            LOG.debug('Exception in diff thread', exc_info=True)
+            put(e)
+            return
+        finally:
+            events.close()
+        put(None)
+
     def __run(self, dry_run=False):
-        # reset stats
+        self.__resetstats()
+        # determine the diff to use (trimmed or untrimmed)
+        d = self.trimdiff if self.runstngs['trimmed'] else self.origdiff
+        if d is None:
+            return
+        return self.runwithdiff(d, dry_run)
+
+    def __resetstats(self):
+        self.stats['phases'] = {'diff':self.__difftime} if not self.__streaming else {}
+        self.stats['bytescopied'] = 0
+        self.stats['logicalbytes'] = 0
         self.stats['creates'] = []
         self.stats['createfails'] = []
         self.stats['updates'] = []
         self.stats['updatefails'] = []
         self.stats['purges'] = []
         self.stats['purgefails'] = []
-        # determine the diff to use (trimmed or untrimmed)
-        d = self.trimdiff if self.runstngs['trimmed'] else self.origdiff
-        if d is None:
-            return
-        return self.runwithdiff(d, dry_run)
+        self.stats['copystrategies'] = {}
+        self.stats['deltasaved'] = {}
+        self.stats['resumed'] = {}
+        self.stats['sparsesaved'] = {}
+        self.stats['hardlinks'] = {}
+
+    def __finishstats(self):
+        """
+        Work out the throughput of the last run and
+        add its totals to ``metrics``
+        """
+        self.stats['statcache'] = {'hits':self.statcache.hits, 'misses':self.statcache.misses}
+        seconds = max(self.stats['etime'] - self.stats['stime'], 1e-9)
+        files = 0
+        for op in self.ops:
+            passes = len(self.stats['{0}s'.format(op)])
+            fails = len(self.stats['{0}fails'.format(op)])
+            files += passes
+            self.metrics.count('{0}s'.format(op), passes)
+            self.metrics.count('{0}fails'.format(op), fails)
+        self.metrics.count('bytes_copied', self.stats['bytescopied'])
+        self.metrics.count('logical_bytes', self.stats['logicalbytes'])
+        self.stats['filespersec'] = files / seconds
+        self.stats['mbpersec'] = self.stats['bytescopied'] / seconds / (1024 * 1024)
+        self.stats['metrics'] = self.metrics.todict()
+
+    def __setphase(self, name):
+        """
+        End the current phase of the run, adding its time to
+        ``stats['phases']`` and ``metrics``, and start the given one
+        """
+        now = time.time()
+        if self.__phase is not None:
+            phase, start = self.__phase
+            self.stats['phases'][phase] = self.stats['phases'].get(phase, 0.0) + now - start
+            self.metrics.addtime(phase, now - start)
+        self.__phase = (name, now) if name is not None else None
 
     def runwithdiff(self, diff, dry_run=False):
         if not isinstance(diff, Diff):
             raise TypeError('expected Diff, got {0}'.format(type(diff).__name__))
-        
+        self.__startprogress(diff)
+        self.__startjournal(diff, dry_run)
+        self.__stopped = False
+        complete = False
+        try:
+            self.__withpool(self.__runwithdiff, diff, dry_run)
+            complete = not self.__stopped
+        finally:
+            if self.__journal is not None:
+                self.__journal.close(complete)
+                self.__journal = None
+
+    def resume(self, dry_run=False, **kwargs):
+        """
+        Continue the run recorded in the ``journal`` run setting without
+        running a new diff. The items that hadn't finished are checked
+        again first, dropping any that no longer need to be run.
+
+        Returns False if there is no journal of a run between src and dst
+        to resume, in which case ``diff`` needs to be run as usual.
+        """
+        self.runstngs.update(kwargs)
+        if not self.runstngs['journal'] or not self.__validate():
+            return False
+        loaded = Journal(self.runstngs['journal']).load(self.src, self.dst)
+        if loaded is None:
+            return False
+        ops, diff = loaded
+        for op in self.ops:
+            self.runstngs[op] = op in ops
+        self.__resetcache()
+        self.__revalidate(diff)
+        self.origdiff = diff
+        self.trimdiff = diff.copy()
+        self.__difftime = 0.0
+        self.__hasrundiff = True
+        self.__diffcurrent = True
+        self.run(dry_run=dry_run)
+        return True
+
+    def __startjournal(self, diff, dry_run=False):
+        """
+        Record the plan of a run of the given diff in the ``journal``
+        """
+        self.__journal = None
+        if not self.runstngs['journal'] or dry_run:
+            return
+        journal = Journal(self.runstngs['journal'])
+        try:
+            journal.start(self.src, self.dst, diff, [op for op in self.ops if self.runstngs[op]])
+        except (IOError, OSError) as e:
+            LOG.warning('Could not write the journal {0}: {1}'.format(journal.path, e))
+            return
+        self.__journal = journal
+
+    def __revalidate(self, diff):
+        """
+        Remove the items of a diff loaded from a journal that have been
+        done since, or no longer exist
+        """
+        precision = self.diffstngs['timeprecision']
+        def copied(srcp):
+            if not self.statcache.exists(srcp):
+                return True
+            dstp = os.path.join(self.dst, os.path.relpath(srcp, self.src))
+            if srcp.endswith(os.sep):
+                return self.statcache.isdir(dstp)
+            if not self.statcache.isfile(dstp):
+                return False
+            s, d = self.statcache.stat(srcp), self.statcache.stat(dstp)
+            return s.st_size == d.st_size and not utils._cmp_stat_mtime(s, d, precision, False)
+        diff.trim('create', predicate=copied)
+        diff.trim('update', predicate=copied)
+        diff.trim('purge', predicate=lambda dstp: not self.statcache.exists(dstp))
+
+    def __withpool(self, fnc, *args):
+        """
+        Call the given function with a copy pool set up if ``copyWorkers``
+        asks for one
+        """
+        workers = self.runstngs['copyWorkers']
+        if workers and workers > 1:
+            self.__pool = WorkerPool(workers)
+        self.__setpurger()
+        try:
+            fnc(*args)
+        except:
+            if self.__pool is not None:
+                self.__pool.cancel()
+            raise
+        finally:
+            if self.__pool is not None:
+                self.__pool.close()
+                self.__pool = None
+            self.__forgettouched()
+            self.__setphase(None)
+
+    def __setpurger(self):
+        """
+        Set up ``purger`` for the current run settings, keeping the
+        existing one if they haven't changed
+        """
+        p = Purger(self.runstngs['purgeWorkers'], self.runstngs['purgeTrash'])
+        if self.purger is None or (p.workers, p.trash) != (self.purger.workers, self.purger.trash):
+            self.purger = p
+
+    def __runwithdiff(self, diff, dry_run=False):
+        self.__startlinks(diff)
         # run through all 'create' files
         if self.runstngs['create']:
             LOG.debug('Creating')
+            self.__setphase('create')
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent += 1
             items = sorted(diff.create.items())
             for path, files in items:
-                if self.progresscheck is not None:
-                    if not self.progresscheck():
-                        return
+                if not self.__checkprogress():
+                    return
                 relpath = os.path.relpath(path, self.src)
                 if relpath == '.':
                     relpath = ''
                 srcdir = os.path.join(self.src, relpath)
                 dstdir = os.path.join(self.dst, relpath)
                 # make the destination dir if it doesn't exist
-                if not os.path.isdir(dstdir):
+                if not self.statcache.isdir(dstdir):
                     self.__makedirs(dstdir, self.stats['creates'], self.stats['createfails'], dry_run)
                 for f in files:
-                    srcp = os.path.join(srcdir, f)
-                    dstp = os.path.join(dstdir, f)
-                    if os.path.isdir(srcp):
-                        self.__copydir(srcp, dstp, self.stats['creates'], self.stats['createfails'], dry_run)
-                    elif os.path.isfile(srcp):
-                        self.__copy(srcp, dstp, self.stats['creates'], self.stats['createfails'], dry_run)
+                    self.__create(os.path.join(srcdir, f), os.path.join(dstdir, f), dry_run)
+            self.__wait()
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent -= 1
         
         # run through all 'update' files
         if self.runstngs['update']:
             LOG.debug('Updating')
+            self.__setphase('update')
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent += 1
             items = sorted(diff.update.items())
             for path, files in items:
-                if self.progresscheck is not None:
-                    if not self.progresscheck():
-                        return
+                if not self.__checkprogress():
+                    return
                 relpath = os.path.relpath(path, self.src)
                 if relpath == '.':
                     relpath = ''
                 srcdir = os.path.join(self.src, relpath)
                 dstdir = os.path.join(self.dst, relpath)
                 for f in files:
-                    # updates never include dirs
-                    srcp = os.path.join(srcdir, f)
-                    dstp = os.path.join(dstdir, f)
-                    self.__copy(srcp, dstp, self.stats['updates'], self.stats['updatefails'], dry_run)
+                    self.__update(os.path.join(srcdir, f), os.path.join(dstdir, f), dry_run)
+            self.__wait()
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent -= 1
+
+        # link the hardlinked files held back by the creates and updates
+        if not self.__runlinks(dry_run):
+            return
         
         # run through all 'purge' files
         if self.runstngs['purge']:
             LOG.debug('Purging')
+            self.__setphase('purge')
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent += 1
             items = sorted(diff.purge.items())
             for path, files in items:
-                if self.progresscheck is not None:
-                    if not self.progresscheck():
-                        return
+                if not self.__checkprogress():
+                    return
                 relpath = os.path.relpath(path, self.dst)
                 if relpath == '.':
                     relpath = ''
                 dstdir = os.path.join(self.dst, relpath)
                 for f in files:
-                    dstp = os.path.join(dstdir, f)
-                    if os.path.isdir(dstp):
-                        self.__rmdir(dstp, self.stats['purges'], self.stats['purgefails'], dry_run)
-                    elif os.path.isfile(dstp):
-                        self.__remove(dstp, self.stats['purges'], self.stats['purgefails'], dry_run)
-                    else:
-                        LOG.debug('file/folder not found: {0}'.format(dstp))
+                    self.__purge(os.path.join(dstdir, f), dry_run)
             if LOG.getEffectiveLevel() <= logging.DEBUG:
                 ROOTLOG.indent -= 1
 
         if self.progressfnc:
             self.progressfnc("Sync Complete", 100)
 
+    def __create(self, srcp, dstp, dry_run=False):
+        if self.statcache.isdir(srcp):
+            self.__copydir(srcp, dstp, self.stats['creates'], self.stats['createfails'], dry_run)
+        elif self.statcache.isfile(srcp):
+            self.__copyfile(srcp, dstp, self.stats['creates'], self.stats['createfails'], dry_run)
+
+    def __update(self, srcp, dstp, dry_run=False):
+        # updates never include dirs
+        self.__copyfile(srcp, dstp, self.stats['updates'], self.stats['updatefails'], dry_run, True)
+
+    def __copyfile(self, srcp, dstp, passes, fails, dry_run=False, delta=False):
+        """
+        Copy the given file on the copy pool, or hold it back for
+        ``__runlinks`` if it may be hardlinked to another file
+        """
+        if self.__haslinks(srcp):
+            self.__linkqueue.append((srcp, dstp, passes, fails, delta))
+        else:
+            self.__submit(self.__copy, srcp, dstp, passes, fails, dry_run, delta)
+
+    def __haslinks(self, srcp):
+        """
+        Return True if the diff groups hardlinks and the given
+        src file has more than one link
+        """
+        if self.__linkdiff is None or not self.__linkdiff.hardlinks:
+            return False
+        try:
+            return getattr(self.statcache.stat(srcp), 'st_nlink', 1) > 1
+        except OSError:
+            return False
+
+    def __startlinks(self, diff):
+        """
+        Start holding back the files that may be hardlinked in the given
+        diff. Its groups are only complete once the walk has finished.
+        """
+        self.__linkdiff = diff
+        self.__linkqueue = []
+
+    def __runlinks(self, dry_run=False):
+        """
+        Copy the first file of each group held back by ``__copyfile``, then
+        link the rest to its dst. Returns False if the run was stopped.
+        """
+        queue, self.__linkqueue = self.__linkqueue, []
+        if not queue:
+            return True
+        LOG.debug('Linking')
+        links = self.__linkdiff.links
+        for srcp, dstp, passes, fails, delta in queue:
+            if srcp not in links:
+                if not self.__checkprogress():
+                    return False
+                self.__submit(self.__copy, srcp, dstp, passes, fails, dry_run, delta)
+        self.__wait()
+        # only files copied by this run are linked to
+        copied = set(self.stats['creates'])
+        copied.update(self.stats['updates'])
+        for srcp, dstp, passes, fails, delta in queue:
+            if srcp in links:
+                if not self.__checkprogress():
+                    return False
+                target = os.path.join(self.dst, os.path.relpath(links[srcp], self.src))
+                if target not in copied:
+                    target = None
+                self.__submit(self.__link, srcp, dstp, target, passes, fails, dry_run, delta)
+        self.__wait()
+        return True
+
+    def __purge(self, dstp, dry_run=False):
+        if self.statcache.isdir(dstp):
+            self.__rmdir(dstp, self.stats['purges'], self.stats['purgefails'], dry_run)
+        elif self.statcache.isfile(dstp):
+            self.__remove(dstp, self.stats['purges'], self.stats['purgefails'], dry_run)
+        else:
+            LOG.debug('file/folder not found: {0}'.format(dstp))
+
+    def __invalidate(self, path, recursive=False):
+        """
+        Drop the given dst path from ``statcache`` once it has been
+        written, and remember its dir for ``__forgettouched``
+        """
+        self.statcache.invalidate(path, recursive=recursive)
+        path = os.path.normpath(path)
+        with self.__lock:
+            dir_ = os.path.dirname(path)
+            self.__touched.setdefault(dir_, False)
+            if recursive:
+                self.__touched[path] = True
+
+    def __forgettouched(self):
+        """
+        Forget the dst dirs written to by the run in the diff's ``manifest``,
+        along with the matching src dirs, so the next diff lists them again
+        """
+        with self.__lock:
+            touched, self.__touched = self.__touched, {}
+        path = self.diffstngs.get('manifest')
+        if not path or not touched:
+            return
+        try:
+            manifest = Manifest(path)
+            try:
+                for dir_, recursive in touched.items():
+                    manifest.forget(dir_, recursive)
+                    rel = os.path.relpath(dir_, self.dst)
+                    if rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+                        manifest.forget(os.path.normpath(os.path.join(self.src, rel)), recursive)
+                manifest.save()
+            finally:
+                manifest.close()
+        except sqlite3.Error as e:
+            LOG.warning('Could not update the manifest {0}: {1}'.format(path, e))
+
+    def __passed(self, passes, path):
+        """
+        Record that the item with the given dst path has finished
+        """
+        if passes is not None:
+            passes.append(path)
+        if self.__journal is not None:
+            self.__journal.done(path)
+
+    def __checkprogress(self):
+        """
+        Return False if ``progresscheck`` asks for the run to stop,
+        skipping any queued copies that haven't started yet
+        """
+        if self.progresscheck is not None:
+            if not self.progresscheck():
+                self.__stopped = True
+                if self.__pool is not None:
+                    self.__pool.cancel()
+                    self.__pool.wait()
+                return False
+        return True
+
+    def __cancelled(self):
+        """
+        Return True if the run has been stopped, checking ``progresscheck``
+        so long copies can stop between chunks. Unlike ``__checkprogress``
+        this doesn't wait for the pool, so it can be called from a worker.
+        """
+        if self.__stopped or (self.__pool is not None and self.__pool.cancelled()):
+            return True
+        if self.progresscheck is not None and not self.progresscheck():
+            self.__stopped = True
+            if self.__pool is not None:
+                self.__pool.cancel()
+            return True
+        return False
+
+    def __submit(self, fnc, *args):
+        """
+        Run the given function on the copy pool, or right away if there isn't one
+        """
+        if self.__pool is not None:
+            self.__pool.submit(fnc, *args)
+        else:
+            fnc(*args)
+
+    def __wait(self):
+        if self.__pool is not None:
+            self.__pool.wait()
+
     def __makedirs(self, dir_, passes=None, fails=None, dry_run=False):
         """
         Make the given dir_ including any parent dirs
@@ -292,40 +870,112 @@ class Sync(object):
         """
         try:
             os.makedirs(dir_)
+            # every new parent changed the listing of the dir above it
+            parent = dir_
+            while len(parent) > len(self.dst):
+                self.__invalidate(parent)
+                parent = os.path.dirname(parent)
         except Exception as e:
             LOG.error(e)
             if fails is not None:
                 fails.append(dir_)
         else:
-            if passes is not None:
-                passes.append(dir_)
+            self.__passed(passes, dir_)
             LOG.debug('made dirs: {0}'.format(dir_))
     
-    def __getProgPercent(self):
+    def __size(self, path):
+        """
+        Return the size of the given file, or 0 if it isn't one
+        """
+        try:
+            entry = self.statcache.entry(path)
+            if entry.is_file():
+                return entry.stat().st_size
+        except OSError:
+            pass
+        return 0
+
+    def __startprogress(self, diff=None):
         """
-        Get a progress percentage and return it.
+        Reset ``progress`` for a run of the given diff, counting the
+        bytes of the files it will copy. The total isn't known without
+        a diff, so the percent stays 0.
+
+        Sizes are only taken from the entries the diff left in
+        ``statcache``, without a lookup that would stat the rest or
+        push the entries the run needs out of the cache. The size each
+        file was counted with is kept until it is done, so ``progress``
+        adds the same amount, and files whose entries aren't cached
+        only count as items.
+        """
+        self.progress.interval = self.runstngs['progressInterval'] / 1000.0
+        self.progress.quantum = self.runstngs['progressQuantum'] * 1024
+        self.__sizes = None
+        items = 0
+        if diff is not None:
+            self.__sizes = {}
+            for op in self.ops:
+                if not self.runstngs[op]:
+                    continue
+                for path, files in getattr(diff, op).items():
+                    items += len(files)
+                    if op != 'purge':
+                        for f in files:
+                            self.__countsize(os.path.join(path, f))
+        self.progress.start(sum(self.__sizes.values()) if self.__sizes else 0, items)
+        self.progressamt = 0
+
+    def __countsize(self, path):
+        """
+        Record the size of the given file for the progress total
+        if its entry is cached
         """
-        self.progressamt += 1
-        return float(self.progressamt) / float(self.origdiff.totalcount) * 100
+        entry = self.statcache.peek(path)
+        try:
+            if entry is not None and entry.is_file():
+                self.__sizes[os.path.normpath(path)] = entry.stat().st_size
+        except OSError:
+            pass
+
+    def __progresssize(self, path, size):
+        """
+        Return the bytes the given file of ``size`` adds to ``progress``,
+        which is the size it was counted with in the total
+        """
+        if self.__sizes is None:
+            return size
+        with self.__lock:
+            return self.__sizes.pop(os.path.normpath(path), 0)
+
+    def __advance(self, nbytes, msg, *args):
+        """
+        Add a finished item to ``progress`` and call ``progressfnc``
+        if a report is due. ``msg`` is only formatted with ``args``
+        when it is reported.
+        """
+        due = self.progress.add(nbytes)
+        self.progressamt = self.progress.items
+        if due and self.progressfnc:
+            self.progressfnc(msg.format(*args), self.progress.percent())
 
     def __copydir(self, src, dst, passes=None, fails=None, dry_run=False):
         """
         Make the given dst directory and copy stats from src
         Append dst to ``fails`` on error
         """
-        if self.progressfnc:
-            self.progressfnc('Copying to {0}'.format(dst), self.__getProgPercent())
+        self.__advance(0, 'Copying to {0}', dst)
         try:
             if not dry_run:
                 os.mkdir(dst)
+                self.__invalidate(dst)
         except Exception as e:
             LOG.error(e)
             if fails is not None:
                 fails.append(dst)
         else:
-            if os.path.exists(dst) and self.runstngs['forceOwnership']:
+            if self.runstngs['forceOwnership'] and self.statcache.exists(dst):
                 # make writable
-                fileAtt = os.stat(dst)[0]
+                fileAtt = self.statcache.stat(dst).st_mode
                 if (not fileAtt & stat.S_IWRITE):
                     try:
                         os.chmod(dst, stat.S_IWRITE)
@@ -333,30 +983,56 @@ class Sync(object):
                         LOG.error('could not make file writable {0}: {1}'.format(dst, e))
                         return False
             shutil.copystat(src, dst)
-            if passes is not None:
-                passes.append(dst)
+            self.__passed(passes, dst)
             LOG.debug('Created Directory: {0}'.format(dst))
     
-    def __copy(self, src, dst, passes=None, fails=None, dry_run=False):
+    def __copy(self, src, dst, passes=None, fails=None, dry_run=False, delta=False):
         """
         Copy the given src file to dst
         Append dst to ``fails`` on error
+        ``delta`` -- allow updating dst in place if it is large enough
         """
-        if self.progressfnc:
-            self.progressfnc('Copying {0} -> {1}'.format(src, dst), self.__getProgPercent())
+        size = self.__size(src)
         try:
             if not dry_run:
-                if os.path.exists(dst) and self.runstngs['forceOwnership']:
+                if self.runstngs['forceOwnership'] and self.statcache.exists(dst):
                     # make writable
-                    fileAtt = os.stat(dst)[0]
+                    fileAtt = self.statcache.stat(dst).st_mode
                     if (not fileAtt & stat.S_IWRITE):
                         try:
                             os.chmod(dst, stat.S_IWRITE)
                         except Exception as e:
                             LOG.error('Could not make file writable {0}: {1}'.format(dst, e))
                             return False
-                shutil.copy2(src, dst)
-        except (IOError, OSError) as e:
+                start = time.time()
+                saved = 0
+                first = self.runstngs['copyStrategy']
+                reflink = first in ('auto', 'reflink')
+                try:
+                    if reflink and transfer.reflink(src, dst, self.__devices(src, dst)):
+                        saved = size
+                        strategy = 'reflink'
+                    elif delta and self.__usedelta(src, dst) and self.__deltacopy(src, dst):
+                        saved = self.stats['deltasaved'][dst]
+                        strategy = 'delta'
+                    elif self.runstngs['sparse'] and transfer.issparse(src, self.statcache.stat(src)):
+                        # a resumable copy would fill in the holes
+                        saved = self.stats['sparsesaved'][dst] = size - transfer.sparsecopy(src, dst)
+                        strategy = 'sparse'
+                    elif self.__useresume(size):
+                        saved = self.stats['resumed'][dst] = transfer.resumablecopy(src, dst, cancelled=self.__cancelled)
+                        strategy = 'resume'
+                    else:
+                        # reflinks were already tried
+                        strategy = transfer.copyfile(src, dst, transfer.STRATEGIES[1] if reflink else first)
+                finally:
+                    self.__invalidate(dst)
+                self.metrics.observe('copy', time.time() - start)
+                self.stats['copystrategies'][dst] = strategy
+                with self.__lock:
+                    self.stats['bytescopied'] += size - saved
+                    self.stats['logicalbytes'] += size
+        except Exception as e:
             if self.runstngs['errorsToDebug']:
                 LOG.debug(e)
             else:
@@ -364,30 +1040,101 @@ class Sync(object):
             if fails is not None:
                 fails.append(dst)
         else:
-            if passes is not None:
-                passes.append(dst)
+            self.__passed(passes, dst)
             LOG.debug('Copied: {0}'.format(dst))
+        finally:
+            self.__advance(self.__progresssize(src, size), 'Copying {0} -> {1}', src, dst)
     
+    def __link(self, src, dst, target, passes=None, fails=None, dry_run=False, delta=False):
+        """
+        Make dst a hardlink of target, the dst of a file that src is
+        hardlinked to. src is copied instead if target is None or
+        can't be linked to.
+        """
+        linked = False
+        if target is not None:
+            try:
+                linked = dry_run or transfer.hardlink(target, dst)
+            except (IOError, OSError) as e:
+                LOG.debug('Could not link {0} to {1}: {2}'.format(dst, target, e))
+        if not linked:
+            return self.__copy(src, dst, passes, fails, dry_run, delta)
+        size = self.__size(src)
+        if not dry_run:
+            self.__invalidate(dst)
+            self.stats['copystrategies'][dst] = 'hardlink'
+            self.stats['hardlinks'][dst] = target
+            with self.__lock:
+                self.stats['logicalbytes'] += size
+        self.__passed(passes, dst)
+        LOG.debug('Linked: {0} -> {1}'.format(dst, target))
+        self.__advance(self.__progresssize(src, size), 'Linking {0} -> {1}', dst, target)
+
+    def __usedelta(self, src, dst):
+        """
+        Return True if dst should be updated with a delta copy
+        """
+        limit = self.runstngs['deltaLimit']
+        if not limit or limit <= 0:
+            return False
+        if not self.statcache.isfile(dst):
+            return False
+        return self.statcache.getsize(src) // 1024 >= limit
+
+    def __devices(self, src, dst):
+        """
+        Return the st_dev of src and of the dir of dst from ``statcache``,
+        so only the first file copied into each dir stats it
+        """
+        return (self.statcache.stat(src).st_dev,
+                self.statcache.stat(os.path.dirname(dst)).st_dev)
+
+    def __deltacopy(self, src, dst):
+        """
+        Update dst with a delta copy and record the bytes it saved.
+        Returns False if dst can't be reflinked to patch it, in which
+        case it should be copied over instead.
+        """
+        saved = transfer.deltacopy(src, dst)
+        if saved is None:
+            with self.__lock:
+                nodelta, self.__nodelta = self.__nodelta, True
+            if not nodelta:
+                LOG.info('deltaLimit is set but {0} can\'t be reflinked, '
+                         'updated files are copied in full'.format(os.path.dirname(dst)))
+            return False
+        self.stats['deltasaved'][dst] = saved
+        return True
+
+    def __useresume(self, size):
+        """
+        Return True if a file of the given size should be copied
+        with a resumable copy
+        """
+        limit = self.runstngs['resumeLimit']
+        return bool(limit) and limit > 0 and size // 1024 >= limit
+
     def __rmdir(self, dir_, passes=None, fails=None, dry_run=False):
         """
         Remove the given dir_.
         Append dir_ to ``fails`` on error
         """
-        if self.progressfnc:
-            self.progressfnc('Deleting {0}'.format(dir_), self.__getProgPercent())
-        if not os.path.isdir(dir_):
+        self.__advance(0, 'Deleting {0}', dir_)
+        if not self.statcache.isdir(dir_):
             LOG.warning('Directory does not exist: {0}'.format(dir_))
             return
         try:
             if not dry_run:
-                shutil.rmtree(dir_)
+                try:
+                    self.purger.remove(dir_)
+                finally:
+                    self.__invalidate(dir_, recursive=True)
         except Exception as e:
             LOG.error(e)
             if fails is not None:
                 fails.append(dir_)
         else:
-            if passes is not None:
-                passes.append(dir_)
+            self.__passed(passes, dir_)
             LOG.debug('Removed dir: {0}'.format(dir_))
     
     def __remove(self, f, passes=None, fails=None, dry_run=False):
@@ -395,30 +1142,29 @@ class Sync(object):
         Delete the given file
         Append f to ``fails`` on error
         """
-        if self.progressfnc:
-            self.progressfnc('Deleting {0}'.format(f), self.__getProgPercent())
-        if not os.path.isfile(f):
+        self.__advance(0, 'Deleting {0}', f)
+        if not self.statcache.isfile(f):
             LOG.warning('File does not exist: {0}'.format(f))
             return
         try:
             if not dry_run:
                 os.remove(f)
+                self.__invalidate(f)
         except OSError as e:
             LOG.error(e)
             if fails is not None:
                 fails.append(f)
         else:
-            if passes is not None:
-                passes.append(f)
+            self.__passed(passes, f)
             LOG.debug('Deleted: {0}'.format(f))
         
-    def report(self, diff=False):
+    def report(self, diff=False, **kwargs):
         if not self.__hasrun or diff:
             if not self.__diffcurrent:
                 LOG.warning('diff is not current')
-            return self.diffreport()
+            return self.diffreport(**kwargs)
         else:
-            self.runreport()
+            return self.runreport(**kwargs)
     
     def diffreport(self, **kwargs):
         """
@@ -432,9 +1178,14 @@ class Sync(object):
         else:
             return self.origdiff.report(**kwargs)
     
-    def runreport(self):
+    def runreport(self, out=None, format='text', summary=False):
         """
         Print a report for the last update/sync/run.
+
+        ``out`` -- a file-like object the report is written to as it is
+            generated. If None the report is logged and returned instead.
+        ``format`` -- 'text', 'jsonl' or 'csv' (see report.WRITERS)
+        ``summary`` -- only report the counts, not the failed items
         """
         if self.src is None:
             LOG.info('No source path is defined')
@@ -442,18 +1193,22 @@ class Sync(object):
         if self.dst is None:
             LOG.info('No destination path is defined')
             return
-        # build title
-        title = 'Sync report ({0} -> {1}):'.format(self.src, self.dst)
-        dashes = '-'*len(title)
-        result = '\n{0}\n{1}\n'.format(title, dashes)
+        buf = StringIO() if out is None else None
+        w = _report.writer(out if buf is None else buf, format, summary)
+        w.header('Sync report ({0} -> {1}):'.format(self.src, self.dst), self.src, self.dst)
         # loop through all attributes
         attrs = ['create', 'update', 'purge']
         for attr in attrs:
             fails = self.stats['{0}fails'.format(attr)]
             passes = self.stats['{0}s'.format(attr)]
-            result += ('\n{attr}: ({0})\n'.format(len(passes), attr=(attr.title() + ' Passes')))
-            result += ('{attr}: ({0})\n'.format(len(fails), attr=(attr.title() + ' Fails')))
+            w.section(attr, len(passes), 'pass')
+            w.section(attr, len(fails), 'fail')
+            if summary:
+                continue
             for item in fails:
-                result += ('  {0}\n'.format(item))
-        LOG.info(result)
-        return result
+                w.item(attr, item, status='fail')
+        w.close()
+        if buf is not None:
+            result = buf.getvalue()
+            LOG.info(result)
+            return result
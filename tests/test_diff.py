@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.diff
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diff
+from diff import Diff
+
+
+class FileListTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.makedirs(os.path.join(self.src, 'a', 'b'))
+        os.makedirs(self.dst)
+        for name in ('a/f', 'a/b/f', 'a/b/g', 'tags', 'x'):
+            open(os.path.join(self.src, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def items(self, d, op='create'):
+        return sorted(os.path.relpath(os.path.join(k, n), self.src)
+                      for k, v in getattr(d, op).items() for n in v)
+
+    def test_nested_paths(self):
+        d = Diff(self.src, self.dst, filelist=['a/b/f', 'a/', 'a/b/g', 'x'])
+        self.assertEqual(self.items(d), ['a', 'a/b', 'a/b/f', 'a/b/g', 'a/f', 'x'])
+        self.assertEqual(d.createcount, 6)
+
+    def test_nested_paths_across_batches(self):
+        batch = diff.FILELISTBATCH
+        diff.FILELISTBATCH = 1
+        try:
+            d = Diff(self.src, self.dst, filelist=['a', 'a/b/f'])
+        finally:
+            diff.FILELISTBATCH = batch
+        self.assertEqual(d.createcount, 5)
+
+    def test_ignored_names_in_filelist(self):
+        d = Diff(self.src, self.dst, filelist=['tags', 'x'])
+        self.assertEqual(self.items(d), ['tags', 'x'])
+        # enough names to list the dir, through the manifest if there's no scandir
+        paths = ['tags', 'x', 'y', 'z']
+        for manifest in (None, os.path.join(self.tmp, 'job.manifest')):
+            d = Diff(self.src, self.dst, filelist=paths, manifest=manifest)
+            self.assertEqual(self.items(d), ['tags', 'x'])
+
+    def test_deprecated_helpers(self):
+        d = Diff()
+        d.src, d.dst = self.src, self.dst
+        rel = d.makeFileListRelative([os.path.join(self.src, 'a', 'f'), os.path.join(self.dst, 'y')],
+                                     self.src, self.dst)
+        self.assertEqual(rel, [os.path.join('a', 'f'), 'y'])
+        result = d.compareFileList(rel, self.src, self.dst)
+        self.assertEqual(result.left_only, [os.path.join('a', 'f')])
+        self.assertEqual(result.missing, ['y'])
+
+    def test_copy(self):
+        filelist = ['a/b/f', 'x']
+        d = Diff(self.src, self.dst, filelist=filelist)
+        d.links[os.path.join(self.src, 'x')] = os.path.join(self.src, 'tags')
+        c = d.copy()
+        c.links.clear()
+        c.filelist.append('tags')
+        self.assertEqual(len(d.links), 1)
+        self.assertEqual(d.filelist, ['a/b/f', 'x'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.journal
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diff import Diff
+from journal import Journal
+from sync import Sync
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        self.path = os.path.join(self.tmp, 'job.journal')
+        os.makedirs(os.path.join(self.src, 'a'))
+        os.makedirs(self.dst)
+        with open(os.path.join(self.src, 'a', 'f'), 'wb') as f:
+            f.write(b'x' * 1000)
+        os.link(os.path.join(self.src, 'a', 'f'), os.path.join(self.src, 'a', 'g'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_links_are_resumed(self):
+        d = Diff(self.src, self.dst, hardlinks=True)
+        self.assertEqual(d.links, {os.path.join(self.src, 'a', 'g'): os.path.join(self.src, 'a', 'f')})
+        j = Journal(self.path)
+        j.start(self.src, self.dst, d, ['create'])
+        j.close()
+        ops, loaded = j.load(self.src, self.dst)
+        self.assertTrue(loaded.hardlinks)
+        self.assertEqual(loaded.links, d.links)
+        s = Sync(self.src, self.dst, journal=self.path, create=True, update=False, purge=False)
+        self.assertTrue(s.resume())
+        f = os.stat(os.path.join(self.dst, 'a', 'f'))
+        g = os.stat(os.path.join(self.dst, 'a', 'g'))
+        self.assertEqual((f.st_dev, f.st_ino), (g.st_dev, g.st_ino))
+
+
+if __name__ == '__main__':
+    unittest.main()
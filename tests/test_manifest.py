@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.manifest
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diff import Diff
+from manifest import Manifest
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        self.path = os.path.join(self.tmp, 'job.manifest')
+        old = time.time() - 60
+        for root in (self.src, self.dst):
+            os.makedirs(os.path.join(root, 'sub'))
+            for name in ('f', 'sub/g'):
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write('old')
+                os.utime(os.path.join(root, name), (old, old))
+            # too old to be racy, so the listings are reused
+            os.utime(os.path.join(root, 'sub'), (old, old))
+            os.utime(root, (old, old))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reuses_listings(self):
+        Diff(self.src, self.dst, manifest=self.path)
+        m = Manifest(self.path)
+        try:
+            self.assertEqual(sorted(e.name for e in m.listdir(self.src)), ['f', 'sub'])
+            m.listdir(os.path.join(self.src, 'sub'))
+            self.assertEqual((m.hits, m.misses), (2, 0))
+        finally:
+            m.close()
+
+    def test_finds_files_modified_in_place(self):
+        d = Diff(self.src, self.dst, manifest=self.path)
+        self.assertEqual(d.totalcount, 0)
+        mtime = os.stat(self.src).st_mtime
+        with open(os.path.join(self.src, 'sub', 'g'), 'w') as f:
+            f.write('new')
+        self.assertEqual(os.stat(self.src).st_mtime, mtime)
+        d = Diff(self.src, self.dst, manifest=self.path)
+        self.assertEqual(list(d.update[os.path.join(self.src, 'sub')]), ['g'])
+
+
+if __name__ == '__main__':
+    unittest.main()
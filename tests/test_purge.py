@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.purge
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import purge
+from purge import Purger
+
+
+class PurgerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        self.outside = os.path.join(self.tmp, 'outside')
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        os.makedirs(os.path.join(self.root, 'c'))
+        os.makedirs(self.outside)
+        for path in ['f', 'a/f', 'a/b/f', 'c/f']:
+            open(os.path.join(self.root, path), 'w').close()
+        open(os.path.join(self.outside, 'keep'), 'w').close()
+        os.symlink(self.outside, os.path.join(self.root, 'a', 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_rmtree(self):
+        for workers in (1, 4):
+            Purger(workers).rmtree(self.root)
+            self.assertFalse(os.path.lexists(self.root))
+            self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+            self.setUp()
+
+    def test_rmtree_without_dir_fd(self):
+        # the path taken on windows, where dirs can't be opened
+        opendir = purge._opendir
+        purge._opendir = lambda path: None
+        try:
+            Purger().rmtree(self.root)
+        finally:
+            purge._opendir = opendir
+        self.assertFalse(os.path.lexists(self.root))
+        self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+
+    def test_rmtree_refuses_symlink(self):
+        link = os.path.join(self.tmp, 'link')
+        os.symlink(self.outside, link)
+        opendir = purge._opendir
+        purge._opendir = lambda path: None
+        try:
+            self.assertRaises(OSError, Purger().rmtree, link)
+        finally:
+            purge._opendir = opendir
+        self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.sync
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync
+import transfer
+from sync import Sync
+
+
+class SyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.makedirs(os.path.join(self.src, 'sub'))
+        os.makedirs(self.dst)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data):
+        with open(os.path.join(self.src, path), 'wb') as f:
+            f.write(data)
+
+    def test_progress_with_small_stat_cache(self):
+        for i in range(50):
+            self.write('sub/f{0}'.format(i), b'x' * (1000 + i))
+        percents = []
+        s = Sync(self.src, self.dst, statCacheSize=10, progressInterval=0)
+        s.progressfnc = lambda msg, percent: percents.append(percent)
+        s.diff()
+        s.sync()
+        self.assertEqual(len(s.stats['creates']), 51)
+        self.assertEqual(s.progress.done, s.progress.total)
+        self.assertEqual(percents, sorted(percents))
+        self.assertTrue(percents[-1] <= 100.0)
+
+    def test_sparse_file_above_resume_limit(self):
+        path = os.path.join(self.src, 'image')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 4096)
+            f.seek(8 * 1024 * 1024)
+            f.write(b'x' * 4096)
+        if not transfer.issparse(path):
+            self.skipTest('the filesystem does not support sparse files')
+        s = Sync(self.src, self.dst, resumeLimit=1024, copyStrategy='copy_file_range')
+        s.diff()
+        s.sync()
+        dst = os.path.join(self.dst, 'image')
+        self.assertEqual(s.stats['copystrategies'][dst], 'sparse')
+        self.assertTrue(transfer.issparse(dst))
+        with open(path, 'rb') as a:
+            with open(dst, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+    def test_delta_without_reflinks_logs_once(self):
+        for i in range(3):
+            self.write('sub/f{0}'.format(i), b'a' * 4096)
+        s = Sync(self.src, self.dst)
+        s.diff()
+        s.sync()
+        for i in range(3):
+            self.write('sub/f{0}'.format(i), b'b' * 4096)
+            os.utime(os.path.join(self.src, 'sub', 'f{0}'.format(i)), (time.time() + 60,) * 2)
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        level = sync.LOG.level
+        sync.LOG.addHandler(handler)
+        sync.LOG.setLevel(logging.INFO)
+        try:
+            s = Sync(self.src, self.dst, deltaLimit=1, copyStrategy='copy_file_range')
+            s.diff()
+            s.sync()
+        finally:
+            sync.LOG.removeHandler(handler)
+            sync.LOG.setLevel(level)
+        if s.stats['deltasaved']:
+            self.skipTest('the filesystem supports reflinks')
+        self.assertEqual(len([m for m in messages if 'deltaLimit' in m]), 1)
+        with open(os.path.join(self.dst, 'sub', 'f0'), 'rb') as f:
+            self.assertEqual(f.read(), b'b' * 4096)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for filesync.transfer
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transfer
+
+
+def _shortcopy(fdin, fdout, count):
+    """
+    A kernel copy that stops early, like copy_file_range on some
+    filesystems, copying 10 bytes and then reporting the end of the file
+    """
+    if os.lseek(fdin, 0, os.SEEK_CUR):
+        return 0
+    return os.write(fdout, os.read(fdin, 10))
+
+
+class CopyFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, 'src')
+        self.dst = os.path.join(self.root, 'dst')
+        with open(self.src, 'wb') as f:
+            f.write(b'0123456789' * 1000)
+        self.patched = (transfer.available, transfer._copy_file_range, transfer._sendfile)
+        transfer.available = lambda strategy: True
+        transfer._copy_file_range = transfer._sendfile = _shortcopy
+
+    def tearDown(self):
+        transfer.available, transfer._copy_file_range, transfer._sendfile = self.patched
+        shutil.rmtree(self.root)
+
+    def test_short_kernel_copy(self):
+        used = transfer.copyfile(self.src, self.dst, 'copy_file_range')
+        self.assertEqual(used, 'copy2')
+        with open(self.src, 'rb') as a:
+            with open(self.dst, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
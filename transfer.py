@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+filesync.transfer
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+File copy strategies used by Sync
+"""
+
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import logging
+
+import utils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+__all__ = [
+    'STRATEGIES',
+    'copyfile',
+    'deltacopy',
+    'hardlink',
+    'ispartial',
+    'issparse',
+    'reflink',
+    'resumablecopy',
+    'sparsecopy',
+]
+
+# strategies in order of preference, each falls back to the next
+STRATEGIES = ['reflink', 'copy_file_range', 'sendfile', 'copy2']
+
+# number of bytes handed to the kernel per call
+CHUNKSIZE = 64 * 1024 * 1024
+
+# size of the blocks compared by deltacopy
+DELTABLOCK = 1024 * 1024
+
+# size of the checksummed chunks written by resumablecopy
+RESUMECHUNK = 16 * 1024 * 1024
+
+# whence values of lseek that find the data and holes of sparse files,
+# python 2 doesn't define them
+if hasattr(os, 'SEEK_DATA'):
+    SEEK_DATA, SEEK_HOLE = os.SEEK_DATA, os.SEEK_HOLE
+elif sys.platform.startswith('linux') or sys.platform.startswith('freebsd'):
+    SEEK_DATA, SEEK_HOLE = 3, 4
+elif sys.platform == 'darwin':
+    SEEK_DATA, SEEK_HOLE = 4, 3
+else:
+    SEEK_DATA = SEEK_HOLE = None
+
+# ioctl that shares the data of one file with another on copy on
+# write filesystems like btrfs and XFS (linux only)
+FICLONE = 0x40049409
+
+# prefixes of the temp file and checkpoint written next to
+# the dst of a resumable copy until it completes
+PARTPREFIX = '.filesync-part.'
+CHECKPOINTPREFIX = '.filesync-ckpt.'
+
+# prefixes of the temp files that replace the dst of a
+# hardlink, reflink or delta copy once they are complete
+LINKPREFIX = '.filesync-link.'
+CLONEPREFIX = '.filesync-clone.'
+DELTAPREFIX = '.filesync-delta.'
+
+# errors that mean a kernel copy isn't supported for these files
+_UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                    errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# errors that mean a reflink isn't supported for these files
+_NOREFLINK = _UNSUPPORTED | set([errno.ENOTTY])
+
+# errors that mean dst can't be hardlinked to target
+_NOLINK = set([errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOSYS,
+               errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# (src dev, dst dev) pairs that reflinks have failed between
+_noreflink = set()
+
+
+def _loadlibc():
+    """
+    Return libc loaded through ctypes, or None if it isn't available
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return None
+    for name, args in [('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]),
+                       ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])]:
+        fnc = getattr(libc, name, None)
+        if fnc is not None:
+            fnc.argtypes = args
+            fnc.restype = ctypes.c_ssize_t
+    return libc
+
+_libc = None
+if not hasattr(os, 'copy_file_range') or not hasattr(os, 'sendfile'):
+    _libc = _loadlibc()
+
+
+def _libccall(name, *args):
+    import ctypes
+    result = getattr(_libc, name)(*args)
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+def _copy_file_range(fdin, fdout, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(fdin, fdout, count)
+    return _libccall('copy_file_range', fdin, None, fdout, None, count, 0)
+
+def _sendfile(fdin, fdout, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(fdout, fdin, None, count)
+    return _libccall('sendfile', fdout, fdin, None, count)
+
+def available(strategy):
+    """
+    Return True if the given strategy can be used on this system
+    """
+    if strategy == 'copy2':
+        return True
+    if strategy == 'reflink':
+        return fcntl is not None and sys.platform.startswith('linux')
+    if hasattr(os, strategy):
+        return True
+    return _libc is not None and getattr(_libc, strategy, None) is not None
+
+
+def _kernelcopy(fnc, fsrc, fdst):
+    """
+    Copy the contents of fsrc to fdst in chunks using the given
+    kernel copy function. Returns False if the function isn't supported
+    for these files and nothing was copied, or if it stopped before the
+    end of fsrc, in which case fdst is emptied to be copied again.
+    """
+    fdin, fdout = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    while True:
+        try:
+            n = fnc(fdin, fdout, CHUNKSIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if n == 0:
+            break
+        copied += n
+    size = os.fstat(fdin).st_size
+    if copied != size:
+        LOG.warning('Kernel copy of {0} stopped after {1} of {2} bytes, '
+                    'copying it again'.format(fsrc.name, copied, size))
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        return False
+    return True
+
+
+def copyfile(src, dst, strategy='auto'):
+    """
+    Copy the src file to dst along with its stats, like shutil.copy2.
+    Returns the name of the strategy that was used.
+
+    ``strategy`` -- the first strategy to try, any of ``STRATEGIES``
+        or 'auto' for the fastest one available. Unsupported strategies
+        fall back to the next one in the list.
+    """
+    if strategy == 'auto':
+        strategy = STRATEGIES[0]
+    if strategy not in STRATEGIES:
+        raise ValueError('unknown copy strategy: {0}'.format(strategy))
+    strategies = STRATEGIES[STRATEGIES.index(strategy):]
+    if strategies[0] == 'reflink':
+        if reflink(src, dst):
+            return 'reflink'
+        strategies = strategies[1:]
+    used = 'copy2'
+    if strategies[0] != 'copy2':
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                for name in strategies:
+                    if name == 'copy2':
+                        shutil.copyfileobj(fsrc, fdst)
+                        break
+                    if not available(name):
+                        continue
+                    fnc = _copy_file_range if name == 'copy_file_range' else _sendfile
+                    if _kernelcopy(fnc, fsrc, fdst):
+                        used = name
+                        break
+        shutil.copystat(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return used
+
+
+def _temppath(dst, prefix):
+    """
+    Return the path of a temp file next to dst that replaces it once complete
+    """
+    dir_, name = os.path.split(dst)
+    return os.path.join(dir_, prefix + name)
+
+def _replace(src, dst):
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+def reflink(src, dst, devices=None):
+    """
+    Clone src to dst with the FICLONE ioctl, so they share the same data
+    on disk until either is modified, and copy the stats of src.
+
+    The clone is made in a temp file next to dst that is renamed over
+    dst once it is complete, so dst is left as it was (or missing) if
+    anything fails. Returns False if reflinks aren't supported between
+    the two files. This is remembered for their devices, so later calls
+    between them return straight away.
+
+    ``devices`` -- the st_dev of src and of the dir of dst if they are
+        already known, so a call between devices that don't support
+        reflinks doesn't stat anything
+    """
+    if not available('reflink'):
+        return False
+    key = devices
+    if key is None:
+        key = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or os.curdir).st_dev)
+    if key in _noreflink:
+        return False
+    tmp = _temppath(dst, CLONEPREFIX)
+    try:
+        with open(src, 'rb') as fsrc:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+            except (IOError, OSError) as e:
+                if e.errno not in _NOREFLINK:
+                    raise
+                LOG.debug('Reflinks are not supported from {0} to {1}: {2}'.format(src, dst, e))
+                _noreflink.add(key)
+                return False
+            finally:
+                os.close(fd)
+        shutil.copystat(src, tmp)
+        _replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def hardlink(target, dst):
+    """
+    Make dst a hardlink of the existing target file, replacing dst if
+    it exists. Returns False if dst can't be linked to target, such as
+    when the filesystem doesn't support hardlinks or target already has
+    as many links as it can.
+    """
+    if not hasattr(os, 'link'):
+        return False
+    if os.path.isfile(dst) and os.path.samefile(target, dst):
+        return True
+    tmp = _temppath(dst, LINKPREFIX)
+    try:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(target, tmp)
+    except OSError as e:
+        if e.errno in _NOLINK:
+            return False
+        raise
+    try:
+        _replace(tmp, dst)
+    except OSError:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def deltacopy(src, dst, blocksize=DELTABLOCK):
+    """
+    Update the existing dst file to match src by comparing them block
+    by block and only writing the blocks that differ. Returns the number
+    of bytes that didn't need to be written, or None if dst can't be
+    reflinked and nothing was done.
+
+    Both files are local so blocks are compared directly instead of
+    through rolling checksums like rsync. The blocks are written to a
+    reflink of dst next to it, which is synced to disk and renamed over
+    dst once complete. Readers of dst and interrupted updates never see
+    a mix of old and new blocks. Without reflinks the duplicate would
+    have to be a full copy of dst, which writes more than copying src,
+    so dst should be copied over as usual instead.
+    """
+    tmp = _temppath(dst, DELTAPREFIX)
+    dev = os.stat(dst).st_dev
+    try:
+        if not reflink(dst, tmp, (dev, dev)):
+            return None
+        saved = _patch(src, tmp, blocksize)
+        shutil.copystat(src, tmp)
+        _replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    return saved
+
+
+def _patch(src, dst, blocksize):
+    """
+    Write the blocks of src that differ from dst into dst, returning
+    the number of bytes that were the same
+    """
+    saved = 0
+    offset = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b') as fdst:
+            while True:
+                a = fsrc.read(blocksize)
+                if not a:
+                    break
+                fdst.seek(offset)
+                b = fdst.read(len(a))
+                if a == b:
+                    saved += len(a)
+                else:
+                    fdst.seek(offset)
+                    fdst.write(a)
+                offset += len(a)
+            fdst.truncate(offset)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+    return saved
+
+
+def ispartial(name):
+    """
+    Return True if the given file name is the temp file or checkpoint of
+    an unfinished resumable copy, or an unfinished hardlink, reflink or
+    delta copy
+    """
+    return name.startswith((PARTPREFIX, CHECKPOINTPREFIX, LINKPREFIX, CLONEPREFIX, DELTAPREFIX))
+
+
+def _partpaths(dst):
+    dir_, name = os.path.split(dst)
+    return os.path.join(dir_, PARTPREFIX + name), os.path.join(dir_, CHECKPOINTPREFIX + name)
+
+
+def _readcheckpoint(path, header):
+    """
+    Return the chunk digests recorded in the given checkpoint, or an
+    empty list if it doesn't exist or was written for a different src
+    """
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().splitlines()
+        if not lines or json.loads(lines[0]) != header:
+            return []
+    except (IOError, OSError, ValueError):
+        return []
+    return [l for l in lines[1:] if l]
+
+
+def _writecheckpoint(path, header, digests):
+    with open(path, 'wb') as f:
+        f.write(json.dumps(header, sort_keys=True) + '\n')
+        for digest in digests:
+            f.write(digest + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _readchunk(f, size, digest=None):
+    """
+    Read up to ``size`` bytes from f in blocks, updating ``digest``
+    with them, and return the blocks
+    """
+    blocks = []
+    while size > 0:
+        block = f.read(min(size, DELTABLOCK))
+        if not block:
+            break
+        if digest is not None:
+            digest.update(block)
+        blocks.append(block)
+        size -= len(block)
+    return blocks
+
+
+def resumablecopy(src, dst, chunksize=RESUMECHUNK, cancelled=None):
+    """
+    Copy the src file to dst along with its stats, so that a copy that
+    is interrupted can carry on where it left off. Returns the number
+    of bytes that were already copied by an earlier attempt.
+
+    The data is written to a temp file next to dst in chunks of
+    ``chunksize``. Each chunk is synced to disk before its sha1 is
+    appended to a checkpoint file, also next to dst. When the copy
+    starts again the chunks in the temp file are checked against the
+    checkpoint and it resumes after the last one that matches. The temp
+    file only replaces dst, in one rename, once it is complete, so dst
+    is never left partly written. A checkpoint written for a different
+    size or mtime of src is ignored and the copy starts over.
+
+    ``cancelled`` -- a function checked before each chunk, returning
+        True to stop the copy. An IOError (EINTR) is raised, leaving the
+        temp file and checkpoint to resume from.
+    """
+    part, checkpoint = _partpaths(dst)
+    st = os.stat(src)
+    header = {'src':utils._text(os.path.abspath(src)), 'size':st.st_size,
+              'mtime':int(st.st_mtime * 1000000), 'chunksize':chunksize}
+    digests = _readcheckpoint(checkpoint, header) if os.path.isfile(part) else []
+    with open(src, 'rb') as fsrc:
+        with open(part, 'r+b' if digests else 'wb') as fdst:
+            # keep the chunks that still match the checkpoint
+            verified = []
+            offset = 0
+            for digest in digests:
+                h = hashlib.sha1()
+                n = sum([len(b) for b in _readchunk(fdst, chunksize, h)])
+                if h.hexdigest() != digest or (n < chunksize and offset + n != st.st_size):
+                    break
+                verified.append(digest)
+                offset += n
+            resumed = offset
+            if digests:
+                LOG.debug('Resuming copy of {0} at {1} bytes'.format(src, offset))
+                fdst.seek(offset)
+                fdst.truncate(offset)
+            _writecheckpoint(checkpoint, header, verified)
+            fsrc.seek(offset)
+            with open(checkpoint, 'ab') as fckpt:
+                while offset < st.st_size or not verified:
+                    if cancelled is not None and cancelled():
+                        raise IOError(errno.EINTR, 'Copy interrupted at {0} bytes'.format(offset), dst)
+                    h = hashlib.sha1()
+                    blocks = _readchunk(fsrc, chunksize, h)
+                    for block in blocks:
+                        fdst.write(block)
+                    fdst.flush()
+                    os.fsync(fdst.fileno())
+                    verified.append(h.hexdigest())
+                    fckpt.write(verified[-1] + '\n')
+                    fckpt.flush()
+                    os.fsync(fckpt.fileno())
+                    n = sum([len(b) for b in blocks])
+                    offset += n
+                    if n < chunksize:
+                        break
+    shutil.copystat(src, part)
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(part, dst)
+    os.remove(checkpoint)
+    return resumed
+
+
+def issparse(path, st=None):
+    """
+    Return True if the given file has fewer blocks allocated than its
+    size needs, so it has holes that ``sparsecopy`` can preserve.
+    ``st`` -- the stat result of the file if it is already known
+    """
+    if SEEK_DATA is None:
+        return False
+    if st is None or getattr(st, 'st_blocks', None) is None:
+        st = os.stat(path)
+    blocks = getattr(st, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < st.st_size
+
+
+def _write(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def sparsecopy(src, dst, blocksize=DELTABLOCK):
+    """
+    Copy the src file to dst along with its stats, only reading and
+    writing the extents that hold data (found with SEEK_DATA and
+    SEEK_HOLE), so the holes of a sparse src stay holes in dst.
+    Returns the number of bytes of data that were copied.
+
+    Filesystems that don't track holes report the whole file as data,
+    in which case this is a plain copy.
+    """
+    copied = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fdin, fdout = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(fdin).st_size
+            offset = 0
+            while offset < size:
+                try:
+                    start = os.lseek(fdin, offset, SEEK_DATA)
+                    end = min(os.lseek(fdin, start, SEEK_HOLE), size)
+                except OSError as e:
+                    # no data after offset, the rest is a hole
+                    if e.errno == errno.ENXIO:
+                        break
+                    # holes aren't supported, copy the rest as data
+                    if e.errno != errno.EINVAL:
+                        raise
+                    start, end = offset, size
+                os.lseek(fdin, start, os.SEEK_SET)
+                os.lseek(fdout, start, os.SEEK_SET)
+                offset = start
+                while offset < end:
+                    data = os.read(fdin, min(end - offset, blocksize))
+                    if not data:
+                        break
+                    _write(fdout, data)
+                    offset += len(data)
+                    copied += len(data)
+                if offset < end:
+                    # src was truncated while copying
+                    break
+            os.ftruncate(fdout, size)
+    shutil.copystat(src, dst)
+    return copied
@@ -10,7 +10,9 @@ Copyright (c) 2012 Moonbot Studios. All rights reserved.
 import os
 import sys
 import stat
+import Queue
 import logging
+import threading
 
 try:
     import mbotenv
@@ -19,6 +21,98 @@ except:
     import logging
     LOG = logging.getLogger(__name__)
 
+try:
+    from os import scandir as _scandir_impl
+except ImportError:
+    try:
+        from scandir import scandir as _scandir_impl
+    except ImportError:
+        _scandir_impl = None
+
+
+class _DirEntry(object):
+    """
+    Stand-in for os.DirEntry used when scandir is not available,
+    or when an entry is needed for a path that didn't come from a listing.
+    Stat results are fetched lazily and cached like the real thing.
+    """
+    __slots__ = ['name', 'path', '_stat', '_lstat']
+
+    def __init__(self, dir_, name):
+        self.name = name
+        self.path = os.path.join(dir_, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            if self.is_symlink():
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self.stat(follow_symlinks=False)
+        return self._stat
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _scandir(path):
+    """
+    Return a list of entries for the given directory.
+    Uses os.scandir (or the scandir module) when available so the
+    entry types come straight from the directory listing.
+    """
+    if _scandir_impl is not None:
+        return list(_scandir_impl(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+def _entry(path):
+    """
+    Return a directory entry for the given path
+    """
+    dir_, name = os.path.split(path.rstrip('/\\'))
+    return _DirEntry(dir_, name)
+
+def _entry_isfile(e):
+    """
+    Same as ``_isfile`` but for a directory entry
+    """
+    try:
+        return not e.is_symlink() and e.is_file()
+    except OSError:
+        return False
+
+def _entry_isdir(e):
+    """
+    Same as ``_isdir`` but for a directory entry
+    """
+    try:
+        return e.is_dir()
+    except OSError:
+        return False
+
 def _isfile(p):
     if os.path.exists(p):
         if not os.path.islink(p):
@@ -39,8 +133,12 @@ def _cmp_mtime(fileA, fileB, precision=3, newer=True):
     ``precision`` -- how many floating point digits to compare the times with.
         precision of 0 compares to seconds
     """
-    stA = os.stat(fileA)
-    stB = os.stat(fileB)
+    return _cmp_stat_mtime(os.stat(fileA), os.stat(fileB), precision, newer)
+
+def _cmp_stat_mtime(stA, stB, precision=3, newer=True):
+    """
+    Same as ``_cmp_mtime`` but for already collected stat results
+    """
     a = round(stA.st_mtime, precision)
     b = round(stB.st_mtime, precision)
     if newer:
@@ -48,6 +146,127 @@ def _cmp_mtime(fileA, fileB, precision=3, newer=True):
     else:
         return a != b
 
+def _mtime_ns(st):
+    """
+    Return the mtime of the given stat result in integer nanoseconds
+    """
+    ns = getattr(st, 'st_mtime_ns', None)
+    if ns is None:
+        ns = int(st.st_mtime * 1000000000)
+    return ns
+
+def _ctime_ns(st):
+    """
+    Return the ctime of the given stat result in integer nanoseconds
+    """
+    ns = getattr(st, 'st_ctime_ns', None)
+    if ns is None:
+        ns = int(st.st_ctime * 1000000000)
+    return ns
+
+def _text(value):
+    """
+    Return the given path, or list of paths, as text that json can write.
+    Paths on python 2 are bytes in any encoding, so each byte is mapped
+    to one character through latin-1 and ``_native`` gets them back.
+    """
+    if isinstance(value, list):
+        return [_text(v) for v in value]
+    if str is bytes and isinstance(value, str):
+        return value.decode('latin-1')
+    return value
+
+def _native(value):
+    """
+    Return the paths loaded by json as the str paths they were
+    written from, json loads them as unicode on python 2
+    """
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    if str is bytes and not isinstance(value, str):
+        return value.encode('latin-1')
+    return value
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads that run submitted functions.
+
+    The queue of waiting work is bounded by ``backlog`` so ``submit``
+    blocks instead of letting the caller run arbitrarily far ahead.
+    After ``cancel`` is called, any work that hasn't started yet is
+    skipped. An unexpected exception raised by the work is re-raised
+    on the next call to ``wait``.
+
+    >>> pool = WorkerPool(8)
+    >>> pool.submit(shutil.copy2, src, dst)
+    >>> pool.wait()
+    >>> pool.close()
+    """
+
+    def __init__(self, workers, backlog=None):
+        self.workers = workers
+        self.__queue = Queue.Queue(backlog or workers * 4)
+        self.__cancelled = threading.Event()
+        self.__error = None
+        self.__threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+    def __work(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is None:
+                    return
+                if self.__cancelled.is_set():
+                    continue
+                fnc, args, kwargs = item
+                try:
+                    fnc(*args, **kwargs)
+                except Exception as e:
+                    LOG.exception('Exception in worker thread')
+                    if self.__error is None:
+                        self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def submit(self, fnc, *args, **kwargs):
+        """
+        Queue ``fnc`` to be called with the given arguments
+        """
+        self.__queue.put((fnc, args, kwargs))
+
+    def wait(self):
+        """
+        Block until all submitted work has finished or been skipped
+        """
+        self.__queue.join()
+        if self.__error is not None:
+            e, self.__error = self.__error, None
+            raise e
+
+    def cancel(self):
+        """
+        Skip any submitted work that hasn't started yet
+        """
+        self.__cancelled.set()
+
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    def close(self):
+        """
+        Stop the worker threads once the current work is done
+        """
+        for t in self.__threads:
+            self.__queue.put(None)
+        for t in self.__threads:
+            t.join()
+        self.__threads = []
+
 def get_os():
     """
     Get the os of the current system in a standard format.
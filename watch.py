@@ -11,34 +11,92 @@ Watch folder components
 
 import os
 import sys
+import stat
 import time
+import Queue
+import errno
 import threading
+import logging
 
+import utils
+import inotify
 from sync import Sync
+from metrics import Metrics
+from purge import Purger
+
+try:
+    import mbotenv
+    LOG = mbotenv.get_logger(__name__)
+except:
+    import logging
+    LOG = logging.getLogger(__name__)
+
+# events that mean something in a watched directory needs syncing
+WATCHMASK = (inotify.IN_CREATE | inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB |
+             inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_DELETE |
+             inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW)
+
+# seconds to wait for more events before syncing a batch of changes
+SETTLE = 0.5
+
+# directories modified this close to the time they were listed are
+# listed again on the next poll, since another change within the same
+# mtime tick would go unnoticed
+RACY = 2.0
 
 class WatchFolder(threading.Thread):
+    """
+    WatchFolder mirrors changes made in the src folder to the dst folder.
+    Anything that already exists in src when the watch starts is left
+    alone unless it gets modified.
+
+    ``watchBackend`` -- 'inotify' reacts to filesystem events and only
+        diffs the paths that changed, 'poll' re-diffs the whole tree every
+        ``watchFreq`` seconds. The default 'auto' uses inotify when it's
+        available and falls back to polling otherwise, which is also needed
+        for network mounts where inotify doesn't see remote changes.
+
+    When polling, only directories whose mtime changed since the last
+    poll are listed and diffed. Files modified in place don't change the
+    mtime of their directory, so the whole tree is still diffed every
+    ``watchRescan`` seconds (every poll if 0). With inotify the whole
+    tree is also diffed every ``watchRescan`` seconds to catch any
+    changes the events missed, or never if it is 0.
+
+    Every sync of the watch records into the same ``metrics``
+    (see metrics.Metrics), so they can be scraped while it runs, and
+    shares the same ``purger`` so trash deletion carries on between them.
+    """
     def __init__(self, src, dst, **kwargs):
         threading.Thread.__init__(self)
-        self.src = src
-        self.dst = dst
+        self.src = os.path.normpath(src)
+        self.dst = os.path.normpath(dst)
         self.freq = 5
         if kwargs.has_key('watchFreq'):
             self.freq = kwargs['watchFreq']
             del kwargs['watchFreq']
+        self.backend = 'auto'
+        if kwargs.has_key('watchBackend'):
+            self.backend = kwargs['watchBackend']
+            del kwargs['watchBackend']
+        self.rescan = 60
+        if kwargs.has_key('watchRescan'):
+            self.rescan = kwargs['watchRescan']
+            del kwargs['watchRescan']
         self.kwargs = kwargs
-
-    def pathWalk(self, path):
-        """
-        Walk through the supplied directory.
-        Return a list of all the file and folder paths.
-        """
-        result = []
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                result.append(os.path.join(root, name))
-            for name in dirs:
-                result.append(os.path.join(root, name))
-        return result
+        self.metrics = Metrics()
+        self.purger = Purger(kwargs.get('purgeWorkers', 1), kwargs.get('purgeTrash'))
+        self.initContents = []
+        self.initMtimes = {}
+        self.__watches = {}
+        self.__srcdirs = {}
+        self.__dstdirs = {}
+        self.__ino = None
+        self.__sync = None
+        self.__pending = set()
+        self.__lastscan = 0
+        self.active = None
+        self.ready = False
 
     def loadInitContents(self, s):
         self.initContents = s.origdiff.create
@@ -50,22 +108,61 @@ class WatchFolder(threading.Thread):
                 mtime = os.stat(path).st_mtime
                 init.append([path, mtime])
         self.initContents = init
+        self.initMtimes = dict(init)
 
-    def getInitContents(self):
+    def trimInitContents(self, s):
         """
-        Check the initital contents for any updates
-        based on modification time.
-        Return a list of paths that haven't been updated.
+        Trim anything from the creates of the given sync that existed
+        on startup and hasn't been modified since. Only the paths that
+        are actually in the diff are checked.
         """
-        result = []
-        for item in self.initContents:
+        unchanged = []
+        for folder, items in s.trimdiff.create.items():
+            for item in items:
+                path = os.path.join(folder, item)
+                if path in self.initMtimes:
+                    try:
+                        if os.stat(path).st_mtime <= self.initMtimes[path]:
+                            unchanged.append(path)
+                    except OSError:
+                        pass
+        s.difftrim(create=unchanged)
+
+    def sweep(self, root, cache):
+        """
+        Stat every directory under root and list the ones whose mtime
+        has changed since the last sweep. ``cache`` maps relative dirs to
+        their (mtime, subdirs) and is updated in place.
+        Return the set of relative dirs that are new or have changed.
+        """
+        dirty = set()
+        seen = {}
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(root, rel)
             try:
-                mtime = os.stat(item[0]).st_mtime
-                if mtime <= item[1]:
-                    result.append(item[0])
-            except:
-                pass
-        return result
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # removed since its parent was listed
+                continue
+            old = cache.get(rel)
+            if old is not None and old[0] == mtime:
+                subdirs = old[1]
+            else:
+                try:
+                    subdirs = [e.name for e in utils._scandir(path) if utils._entry_isdir(e)]
+                except OSError:
+                    continue
+                dirty.add(rel)
+                if mtime >= time.time() - RACY:
+                    mtime = None
+            seen[rel] = (mtime, subdirs)
+            stack.extend([os.path.join(rel, x) for x in subdirs])
+        # anything no longer seen was removed along with its parent
+        cache.clear()
+        cache.update(seen)
+        return dirty
 
     def progress(self, msg, perc):
         """
@@ -74,16 +171,402 @@ class WatchFolder(threading.Thread):
         sys.stdout.write("\n" + msg.replace(self.dst, ''))
         sys.stdout.flush()
 
+    def setup(self):
+        """
+        Pick the backend, record the initial contents and
+        run a first full pass
+        """
+        self.close()
+        if self.backend in ('auto', 'inotify'):
+            if inotify.available():
+                try:
+                    self.__ino = inotify.Inotify()
+                    self.__watches = {}
+                    self.addwatches(self.__ino, self.src)
+                except OSError as e:
+                    LOG.warning('Could not watch {0} with inotify, polling instead: {1}'.format(self.src, e))
+                    self.close()
+            elif self.backend == 'inotify':
+                LOG.warning('inotify is not available, polling instead')
+        s = self.__newsync()
+        s.diff()
+        self.loadInitContents(s)
+        self.__sync = s
+        self.__pending = set()
+        self.active = 'poll' if self.__ino is None else 'inotify'
+        self.fullsync()
+        self.ready = True
+
+    def close(self):
+        """
+        Release the inotify watches, if any
+        """
+        if self.__ino is not None:
+            self.__ino.close()
+            self.__ino = None
+        self.ready = False
+
+    def cycle(self):
+        """
+        Sync everything that changed since the last cycle.
+        ``setup`` must be called first.
+        """
+        if self.__ino is not None:
+            while self.readevents(0):
+                pass
+            if self.__rescanwait() == 0:
+                self.__pending.add(None)
+            self.flushevents()
+            if not os.path.isdir(self.src):
+                # nothing is watched anymore, setup has to run again
+                raise OSError(errno.ENOENT, 'Watched folder was removed', self.src)
+        elif not self.rescan or time.time() - self.__lastscan >= self.rescan:
+            self.fullsync()
+        else:
+            dirty = self.sweep(self.src, self.__srcdirs)
+            dirty |= self.sweep(self.dst, self.__dstdirs)
+            if dirty:
+                self.syncdirs(dirty)
+
     def run(self):
         """
         Thread: Run
         """
-        s = Sync(self.src, self.dst, **self.kwargs)
+        self.setup()
+        try:
+            if self.__ino is None:
+                while True:
+                    time.sleep(self.freq)
+                    self.cycle()
+            start = None
+            while True:
+                timeout = SETTLE if self.__pending else None
+                wait = self.__rescanwait()
+                if wait is not None and (timeout is None or wait < timeout):
+                    timeout = wait
+                count = self.readevents(timeout)
+                if self.__rescanwait() == 0:
+                    # catch anything the events missed
+                    self.__pending.add(None)
+                    self.flushevents()
+                    start = None
+                    continue
+                if self.__pending and start is None:
+                    start = time.time()
+                # sync once things settle down, or every ``freq`` seconds
+                # if they don't
+                if self.__pending and (not count or time.time() - start > self.freq):
+                    self.flushevents()
+                    start = None
+        finally:
+            self.close()
+
+    def fullsync(self):
+        """
+        Diff and sync the whole tree
+        """
+        self.__lastscan = time.time()
+        if self.__ino is None:
+            self.sweep(self.src, self.__srcdirs)
+            self.sweep(self.dst, self.__dstdirs)
+        s = self.__sync
         s.diff()
-        self.loadInitContents(s)
+        self.trimInitContents(s)
+        s.run()
+
+    def __rescanwait(self):
+        """
+        Return the seconds until the next full diff is due in inotify
+        mode, or None if ``rescan`` is 0
+        """
+        if not self.rescan:
+            return None
+        return max(0.0, self.__lastscan + self.rescan - time.time())
+
+    def __newsync(self):
+        s = Sync(self.src, self.dst, **self.kwargs)
+        s.metrics = self.metrics
+        s.purger = self.purger
         s.progressfnc = self.progress
+        return s
+
+    def syncdirs(self, dirs):
+        """
+        Diff and sync the contents of the given dirs relative to src
+        """
+        s = self.__newsync()
+        s.diff(dirlist=sorted(dirs))
+        self.trimInitContents(s)
+        s.run()
+
+    def readevents(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds for inotify events and add the
+        paths they affect to the pending changes.
+        Return the number of events read.
+        """
+        events = self.__ino.read(timeout)
+        for wd, mask, cookie, name in events:
+            path = self.handleevent(self.__ino, wd, mask, name)
+            if path is not False:
+                self.__pending.add(path)
+        return len(events)
+
+    def flushevents(self):
+        """
+        Sync all pending changes
+        """
+        pending, self.__pending = self.__pending, set()
+        if None in pending:
+            # events were lost, fall back to a full diff
+            self.fullsync()
+        elif pending:
+            self.syncpaths(pending)
+
+    def addwatches(self, ino, path):
+        """
+        Watch the given directory and all the directories below it
+        """
+        for root, dirs, files in os.walk(path):
+            try:
+                wd = ino.add_watch(root, WATCHMASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # out of watches, let the caller fall back to polling
+                    raise
+                # the dir was removed before it could be watched
+                continue
+            self.__watches[wd] = root
+
+    def removewatches(self, ino, path):
+        """
+        Stop watching the given directory and all the directories below it
+        """
+        prefix = path + os.sep
+        for wd, p in self.__watches.items():
+            if p == path or p.startswith(prefix):
+                ino.rm_watch(wd)
+                del self.__watches[wd]
+
+    def handleevent(self, ino, wd, mask, name):
+        """
+        Update the watches for the given event and return the changed
+        path relative to src, None if everything needs to be diffed,
+        or False if nothing needs to be synced
+        """
+        if mask & inotify.IN_Q_OVERFLOW:
+            LOG.warning('inotify queue overflowed, running a full diff')
+            return None
+        if mask & inotify.IN_IGNORED:
+            self.__watches.pop(wd, None)
+            return False
+        dir_ = self.__watches.get(wd)
+        if dir_ is None or not name:
+            return False
+        path = os.path.join(dir_, name)
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.addwatches(ino, path)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self.removewatches(ino, path)
+            else:
+                # syncing the dir would pull in everything inside it
+                return False
+        elif mask & inotify.IN_CREATE and not self.__closeless(path):
+            # wait for the file to be closed
+            return False
+        return os.path.relpath(path, self.src)
+
+    def __closeless(self, path):
+        """
+        Return True if the given new entry won't be followed by an
+        IN_CLOSE_WRITE, like symlinks, device nodes and hardlinks of
+        existing files, so it has to be synced when it is created
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            # already removed again
+            return False
+        return not stat.S_ISREG(st.st_mode) or st.st_nlink > 1
+
+    def syncpaths(self, paths):
+        """
+        Diff and sync only the given paths relative to src
+        """
+        # the diff recurses into dirs, so skip anything inside another path.
+        # sorting by parts puts everything inside a path right after it,
+        # where a plain sort would put 'a-b' between 'a' and 'a/c'
+        paths = sorted(paths, key=lambda x: x.split(os.sep))
+        result = []
+        for path in paths:
+            if result and path.startswith(result[-1] + os.sep):
+                continue
+            result.append(path)
+        s = self.__newsync()
+        s.diff(filelist=result)
+        self.trimInitContents(s)
+        s.run()
+
+
+class WatchScheduler(object):
+    """
+    WatchScheduler watches many src/dst pairs at once, sharing a fixed
+    number of worker threads between them.
+
+    Each pair is synced at most every ``watchFreq`` seconds and never by
+    more than one worker at a time. Pairs that are due are queued in the
+    order they became due so a busy pair can't keep the others waiting.
+    A cycle that runs longer than ``stuckAfter`` seconds marks its pair
+    as stuck and another worker is started in its place, so a hung
+    network share doesn't take a worker away from the healthy pairs.
+    No more than ``maxWorkers`` threads are started in all (twice
+    ``workers`` by default), since a stuck thread can't be stopped. A
+    stuck worker retires once its cycle returns if it was replaced.
+    Pairs that fail are retried with an increasing delay.
+    All pairs record into the same ``metrics``.
+
+    >>> s = WatchScheduler([('/src/a', '/dst/a'), ('/src/b', '/dst/b')], workers=2)
+    >>> s.run()
+    """
+
+    # longest delay in seconds between retries of a failing pair
+    MAXBACKOFF = 300
+
+    def __init__(self, pairs, workers=4, stuckAfter=600, maxWorkers=None, **kwargs):
+        self.workers = max(1, workers)
+        self.maxWorkers = max(self.workers, maxWorkers or self.workers * 2)
+        self.stuckAfter = stuckAfter
+        self.folders = []
+        self.__status = []
+        self.__lock = threading.Lock()
+        self.__queue = Queue.Queue()
+        self.__running = {}
+        self.__threads = 0
+        self.metrics = Metrics()
+        for src, dst in pairs:
+            folder = WatchFolder(src, dst, **kwargs)
+            folder.metrics = self.metrics
+            self.folders.append(folder)
+            self.__status.append(dict(src=src, dst=dst, state='idle', backend=None,
+                                      runs=0, errors=0, failures=0, lasterror=None, lastrun=None,
+                                      duration=None, nextrun=0))
+
+    def status(self):
+        """
+        Return a list with the status of each pair
+        """
+        with self.__lock:
+            return [dict(s) for s in self.__status]
+
+    def report(self):
+        """
+        Log the status of each pair
+        """
+        now = time.time()
+        for s in self.status():
+            age = '-' if s['lastrun'] is None else '{0:.0f}s ago'.format(now - s['lastrun'])
+            LOG.info('{0} -> {1}: {2} ({3}), {4} runs, {5} errors, last run {6}'.format(
+                s['src'], s['dst'], s['state'], s['backend'] or '-', s['runs'], s['errors'], age))
+            if s['lasterror']:
+                LOG.info('    last error: {0}'.format(s['lasterror']))
+
+    def run(self, interval=0.25, reportInterval=300):
+        """
+        Schedule the pairs forever, checking for due and stuck
+        pairs every ``interval`` seconds. The status of the pairs is
+        logged every ``reportInterval`` seconds (never if 0) and when
+        the scheduler stops.
+        """
+        with self.__lock:
+            self.__threads += self.workers
+        for i in range(self.workers):
+            self.__spawn()
+        lastreport = time.time()
+        try:
+            while True:
+                self.schedule()
+                if reportInterval and time.time() - lastreport >= reportInterval:
+                    self.report()
+                    lastreport = time.time()
+                time.sleep(interval)
+        finally:
+            self.report()
+
+    def schedule(self):
+        """
+        Queue all pairs that are due and replace the workers
+        of any pairs that got stuck
+        """
+        now = time.time()
+        spawn = 0
+        with self.__lock:
+            for index, s in enumerate(self.__status):
+                if s['state'] in ('idle', 'error') and s['nextrun'] <= now:
+                    self.__setstate(index, 'queued')
+                    self.__queue.put(index)
+                elif s['state'] == 'running' and now - self.__running[index] > self.stuckAfter:
+                    self.__setstate(index, 'stuck')
+                    if self.__threads < self.maxWorkers:
+                        # the stuck worker retires when its cycle returns
+                        self.__threads += 1
+                        spawn += 1
+                    else:
+                        LOG.warning('{0} -> {1}: not replaced, {2} workers are already running'.format(
+                                    s['src'], s['dst'], self.__threads))
+        for i in range(spawn):
+            self.__spawn()
+
+    def __setstate(self, index, state):
+        s = self.__status[index]
+        if state in ('stuck', 'error'):
+            LOG.warning('{0} -> {1}: {2}'.format(s['src'], s['dst'], state))
+        elif state == 'idle' and (s['state'] == 'stuck' or s['failures']):
+            LOG.info('{0} -> {1}: recovered'.format(s['src'], s['dst']))
+        s['state'] = state
+
+    def __spawn(self):
+        t = threading.Thread(target=self.__worker)
+        t.daemon = True
+        t.start()
+
+    def __worker(self):
         while True:
-            s.diff()
-            s.difftrim(create=self.getInitContents())
-            s.run()
-            time.sleep(self.freq)
\ No newline at end of file
+            index = self.__queue.get()
+            with self.__lock:
+                self.__setstate(index, 'running')
+                self.__running[index] = time.time()
+            folder = self.folders[index]
+            error = None
+            try:
+                if folder.ready:
+                    folder.cycle()
+                else:
+                    folder.setup()
+            except Exception as e:
+                LOG.exception('Exception watching {0}'.format(folder.src))
+                error = e
+                folder.close()
+            now = time.time()
+            with self.__lock:
+                s = self.__status[index]
+                stuck = s['state'] == 'stuck'
+                start = self.__running.pop(index)
+                s['duration'] = now - start
+                s['lastrun'] = now
+                s['backend'] = folder.active
+                if error is None:
+                    s['runs'] += 1
+                    s['nextrun'] = now + folder.freq
+                    self.__setstate(index, 'idle')
+                    s['failures'] = 0
+                else:
+                    s['errors'] += 1
+                    s['failures'] += 1
+                    s['lasterror'] = str(error)
+                    s['nextrun'] = now + min(folder.freq * 2 ** s['failures'], self.MAXBACKOFF)
+                    self.__setstate(index, 'error')
+                if stuck and self.__threads > self.workers:
+                    # already replaced by another worker
+                    self.__threads -= 1
+                    return